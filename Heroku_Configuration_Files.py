@@ -4,11 +4,12 @@ pandas
 numpy
 plotly
 shinywidgets
-gunicorn
+uvicorn
 python-multipart
+scipy
 
 # File 2: Procfile (no file extension)
-web: gunicorn app_Jorge_Merged_version:app --timeout 120
+web: python serve.py app_Jorge_Merged_version:app --port $PORT
 
 # File 3: runtime.txt
 python-3.9.18
@@ -1,14 +1,21 @@
 import faicons as fa
-import plotly.express as px
 
 # Load data and compute static values
-from shared import app_dir, shopping_trends
-from shiny import reactive, render
-from shiny.express import input, ui
+import schema
+from dashboard import (
+    bill_summary_of, filter_mask_of, purchase_range, ridge_figure, rows_mask,
+    scatter_figure, table_columns, table_pager_of,
+)
+from persistent import PERSISTENT_WIDGETS, PersistentFigure
+from ratelimit import debounce, interval
+import shared
+from shared import app_dir, query_backend
+from stream import watch
+from workers import BackgroundCalc, executor
+from shiny import reactive, render, req
+from shiny.express import input, session, ui
 from shinywidgets import render_plotly
 
-purchase_range = (min(shopping_trends.Purchase_Amount_USD), max(shopping_trends.Purchase_Amount_USD))
-
 # Add page title and sidebar
 ui.page_opts(title="Shopping Trends Analysis by Jorge", fillable=True)
 
@@ -44,7 +51,7 @@ with ui.layout_columns(fill=False):
 
         @render.express
         def total_tippers():
-            shopping_trends_data().shape[0]
+            bill_summary()[0]
 
     with ui.value_box(showcase=ICONS["wallet"]):
         "Average tip"
@@ -61,19 +68,40 @@ with ui.layout_columns(fill=False):
 
         @render.express
         def average_bill():
-            d = shopping_trends_data()
-            if d.shape[0] > 0:
-                bill = d.Purchase_Amount_USD.mean()
+            n_rows, bill = bill_summary()
+            if n_rows > 0:
                 f"${bill:.2f}"
 
 
 with ui.layout_columns(col_widths=[6, 6, 12]):
     with ui.card(full_screen=True):
-        ui.card_header("Shopping Trends data") # updated card title
+        with ui.card_header(class_="d-flex justify-content-between align-items-center"):
+            "Shopping Trends data" # updated card title
+            with ui.popover(title="Page, sort and filter", placement="top"):
+                ICONS["ellipsis"]
+                ui.input_numeric("table_page", "Page", 1, min=1)
+                ui.input_select("table_sort", "Sort by", ["", *table_columns])
+                ui.input_checkbox("table_desc", "Descending")
+                ui.input_select("table_filter_col", "Filter column", table_columns)
+                ui.input_text("table_filter", "Contains / range", placeholder="e.g. Cali or 20-40")
 
+        # Only the current page is sent; sorting and filtering happen here
         @render.data_frame
         def table():
-            return render.DataGrid(shopping_trends_data())
+            pager = table_pager()
+            number = pager.clamp(input.table_page())
+            # Build the next page on the worker pool once this one has gone
+            # out; with a query backend that's a query the loop mustn't wait on
+            session.on_flushed(lambda: executor.submit(pager.prefetch, number + 1), once=True)
+            return render.DataGrid(pager.page(number))
+
+        with ui.card_footer():
+
+            @render.text
+            def table_rows_shown():
+                pager = table_pager()
+                first, last = pager.bounds(input.table_page())
+                return f"Rows {first:,}-{last:,} of {pager.n_rows:,} (page {pager.clamp(input.table_page())} of {pager.n_pages})"
 
     with ui.card(full_screen=True):
         with ui.card_header(class_="d-flex justify-content-between align-items-center"):
@@ -89,14 +117,8 @@ with ui.layout_columns(col_widths=[6, 6, 12]):
 
         @render_plotly
         def scatterplot():
-            color = input.scatter_color()
-            return px.scatter(
-                shopping_trends_data(),
-                x="Purchase_Amount_USD",
-                y="Age",
-                color=None if color == "None" else color, # updated none -> None to match what was listed
-                trendline="lowess",
-            )
+            # Built on the worker pool; see scatter_figure() below
+            return scatter_widget()
 
     with ui.card(full_screen=True):
         with ui.card_header(class_="d-flex justify-content-between align-items-center"):
@@ -113,30 +135,8 @@ with ui.layout_columns(col_widths=[6, 6, 12]):
 
         @render_plotly
         def tip_perc():
-            from ridgeplot import ridgeplot
-
-            dat = shopping_trends_data()
-            dat["percent"] = dat.Previous_Purchases / dat.Purchase_Amount_USD # dat.tip -> dat.Previous_Purchases
-            yvar = input.pp_perc_y() # input.tip_perc_y() -> input.pp_perc_y()
-            uvals = dat[yvar].unique()
-
-            samples = [[dat.percent[dat[yvar] == val]] for val in uvals]
-
-            plt = ridgeplot(
-                samples=samples,
-                labels=uvals,
-                bandwidth=0.01,
-                colorscale="viridis",
-                colormode="row-index",
-            )
-
-            plt.update_layout(
-                legend=dict(
-                    orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5
-                )
-            )
-
-            return plt
+            # Built on the worker pool; see ridge_figure() below
+            return ridge_widget()
 
 
 ui.include_css(app_dir / "styles.css")
@@ -146,12 +146,63 @@ ui.include_css(app_dir / "styles.css")
 # --------------------------------------------------------
 
 
+# The filters, passed on once they settle so dragging the slider doesn't
+# rebuild everything for each intermediate value
+@debounce(interval("Purchase_Amount_USD", 0.3))
+def bill_range():
+    return tuple(input.Purchase_Amount_USD())
+
+
+@debounce(interval("Gender", 0.15))
+def genders():
+    return tuple(input.Gender())
+
+
+@reactive.calc
+def filter_state():
+    # Hashable snapshot of the filters, with labels translated to codes once
+    # per change; used as a cache key for derived results. It includes the
+    # data revision, which only moves on when streamed rows match the filters.
+    appended_rows()
+    return (bill_range(), tuple(schema.encode("Gender", genders())), shared.data_revision)
+
+
+appended_rows = watch(filter_state, lambda state: state[2], rows_mask)
+
+
+@reactive.calc
+def filter_mask():
+    return filter_mask_of(filter_state())
+
+
 @reactive.calc
 def shopping_trends_data():
-    bill = input.Purchase_Amount_USD()
-    idx1 = shopping_trends.Purchase_Amount_USD.between(bill[0], bill[1])
-    idx2 = shopping_trends.Gender.isin(input.Gender()) # updated Age -> Gender because this filter should match what's on the left side
-    return shopping_trends[idx1 & idx2]
+    # With a query backend the rows stay in the database; outputs ask it for
+    # what they show instead
+    req(query_backend is None)
+    return shared.frame_at(filter_state()[2])[filter_mask()]
+
+
+@reactive.calc
+def bill_summary():
+    return bill_summary_of(filter_state())
+
+
+@reactive.calc
+def table_pager():
+    table_state = (input.table_filter_col(), input.table_filter(), input.table_sort(), input.table_desc())
+    return table_pager_of(filter_state(), table_state)
+
+
+# The figures (see dashboard.py) don't read reactive values, so they're built
+# on a worker thread (see workers.py); each is built once per filter state and
+# option across all sessions
+scatter_job = BackgroundCalc(scatter_figure, lambda: (filter_state(), input.scatter_color()))
+ridge_job = BackgroundCalc(ridge_figure, lambda: (filter_state(), input.pp_perc_y())) # input.tip_perc_y() -> input.pp_perc_y()
+
+# With persistent widgets, each plot keeps its widget and gets patched (see persistent.py)
+scatter_widget = PersistentFigure("scatterplot", scatter_job).widget if PERSISTENT_WIDGETS else scatter_job
+ridge_widget = PersistentFigure("tip_perc", ridge_job).widget if PERSISTENT_WIDGETS else ridge_job
 
 
 @reactive.effect
@@ -1,32 +1,467 @@
-from shiny import App, ui, render
+import os
+import threading
+
+from shiny import App, reactive, render, ui
 from shinywidgets import output_widget, render_widget
-import pandas as pd
 import plotly.express as px
 import numpy as np
 
-# Load your dataset (update the path accordingly)
-df = pd.read_csv("./data/shopping_trends_imputed.csv")
+# Shared dataset and its precomputed filter index (see shared.py). The imputed
+# data has no missing values; categorical columns are int8 codes whose labels
+# live in schema.py.
+import schema
+from hypothesis import RESAMPLES, chi_square, compare_means, crosstab, value_counts
+from incremental import IncrementalRollup
+from lod import lod_scatter
+from metrics import with_metrics
+from persistent import PERSISTENT_WIDGETS, PersistentFigure
+from ratelimit import debounce, interval
+from result_cache import cached_figure, cached_mask, result_cache
+import shared
+from shared import query_backend, use_cube, use_filter_index
+from stream import watch
+from workers import BackgroundCalc
+
+# Groupings of the spending charts that read the filtered selection
+SPENDING_GROUPINGS = [
+    ("Gender",),
+    ("Category",),
+    ("Season", "Category"),
+    ("Season",),
+    ("Discount_Applied",),
+    ("Subscription_Status", "Discount_Applied"),
+]
+PAYMENT_GROUPINGS = [("Payment_Method",)]
+
+# Sidebar values every session starts with. Their tables and figures are built
+# when the module loads (set SHINY_WARM_UP=0 to skip), so a new session's first
+# paint comes from memory.
+DEFAULT_FILTERS = {
+    "age_range": (35, 60),
+    "category": "All",
+    "season": "All",
+    "gender": [],
+    "payment_method": [],
+}
+warm_up_on_load = os.environ.get("SHINY_WARM_UP", "1") != "0"
+
+
+def filter_values_of(gender, category, season):
+    # Selected sidebar values as label codes, so the filters compare integers.
+    # Unfiltered columns are left out.
+    values = {}
+    if gender:
+        values["Gender"] = schema.encode("Gender", gender)
+    if category != "All":
+        values["Category"] = schema.encode("Category", [category])
+    if season != "All":
+        values["Season"] = schema.encode("Season", [season])
+    return values
+
+
+# The filters as one plain value (a "state"). Results derived from a state are
+# shared between sessions through the result cache under it. The payment
+# methods only filter the payment chart, so the other results are keyed on
+# the base state without them. The data revision says which rows there were
+# (see shared.append_rows).
+def selection_state(age_range, gender, category, season, revision=0):
+    return {
+        "age_range": tuple(age_range),
+        "values": filter_values_of(gender, category, season),
+        "revision": revision,
+    }
+
+
+def with_payment_methods(state, payment_method):
+    return {**state, "payment_methods": schema.encode("Payment_Method", payment_method)}
+
+
+def base_state(state):
+    return {"age_range": state["age_range"], "values": state["values"], "revision": state["revision"]}
+
+
+def rows_mask(state, rows):
+    # Filter dataset by selected age range
+    age_min, age_max = state["age_range"]
+    mask = (rows['Age'] >= age_min) & (rows['Age'] <= age_max)
+    # Filter by gender, product category and season
+    for col, codes in state["values"].items():
+        mask &= rows[col].isin(codes)
+    return mask.to_numpy()
+
+
+def selection_mask(state):
+    if use_filter_index:
+        mask = shared.filter_index.mask(ranges={"Age": state["age_range"]}, values=state["values"])
+        return mask[:shared.rows_at(state["revision"])]
+    return rows_mask(state, shared.frame_at(state["revision"]))
+
+
+def filtered_mask_of(state):
+    state = base_state(state)
+    return cached_mask("jorge.filtered_mask", state, lambda: selection_mask(state))
+
+
+def payment_mask_of(state):
+    # Payment method sub-filter, stacked on the shared filter so changing the
+    # payment methods doesn't re-run the base filter
+    if not state["payment_methods"]:
+        return filtered_mask_of(state)
+
+    def compute():
+        mask = filtered_mask_of(state)
+        n_rows = shared.rows_at(state["revision"])
+        if use_filter_index:
+            return mask & shared.filter_index.mask(values={"Payment_Method": state["payment_methods"]})[:n_rows]
+        return mask & shared.frame_at(state["revision"])['Payment_Method'].isin(state["payment_methods"]).to_numpy()
+
+    return cached_mask("jorge.payment_mask", state, compute)
+
+
+def selection_of(state):
+    # The filters as a query on the backend (see query.py), payment methods included
+    values = dict(state["values"])
+    if state.get("payment_methods"):
+        values["Payment_Method"] = state["payment_methods"]
+    return query_backend.select(ranges={"Age": state["age_range"]}, values=values)
+
+
+def cube_cells_of(state, cube):
+    # The same filters as cells of the spending cube, or None when the cube
+    # can't answer them and the charts have to aggregate the filtered rows
+    if not use_cube:
+        return None
+    cells = cube.cell_mask(ranges={"Age": state["age_range"]}, values=state["values"])
+    if cells is not None and state.get("payment_methods"):
+        cells = cells & np.isin(cube.cells["Payment_Method"], state["payment_methods"])
+    return cells
+
+
+def rollup_means(rollup, groupings):
+    # Mean spending per group of each grouping, and overall under ()
+    means = {tuple(by): rollup.mean(by) for by in groupings}
+    means[()] = rollup.overall_mean()
+    return means
+
+
+class Rollups:
+    """Running per-group sums and counts of one session's selections.
+
+    Each filter change applies only the cube cells (or, when the cube can't
+    answer, the rows) that entered or left the selection; see
+    IncrementalRollup. The row versions are built on first use, and both are
+    rebuilt when streamed rows replace the cube or frame they were built on.
+    A selection is always summed over the cube or frame of its own revision,
+    or over the rows when that cube is no longer kept. Figures are built on
+    worker threads, so updates take a lock.
+    """
+
+    def __init__(self):
+        self._rollups = {}
+        self._lock = threading.Lock()
+
+    def means(self, name, groupings, state, rows_mask):
+        cube = shared.cube_at(state["revision"])
+        cells = None if cube is None else cube_cells_of(state, cube)
+        source = shared.frame_at(state["revision"]) if cells is None else cube
+        key = (name, "rows" if cells is None else "cube")
+        with self._lock:
+            if key not in self._rollups or self._rollups[key][0] is not source:
+                if cells is not None:
+                    rollup = IncrementalRollup.from_cube(cube, groupings)
+                else:
+                    rollup = IncrementalRollup.from_rows(source, "Purchase_Amount_USD", groupings)
+                self._rollups[key] = (source, rollup)
+            rollup = self._rollups[key][1].update(rows_mask() if cells is None else cells)
+            return rollup_means(rollup, groupings)
+
+
+# Mean spending tables of a selection. Sessions with the same filters share
+# them; a session's rollups only move when it computes them. With a query
+# backend the database groups the rows instead.
+def spending_means_of(state, rollups):
+    state = base_state(state)
+
+    def compute():
+        if query_backend is not None:
+            return selection_of(state).means("Purchase_Amount_USD", SPENDING_GROUPINGS)
+        return rollups.means("filters", SPENDING_GROUPINGS, state, lambda: filtered_mask_of(state))
+
+    return result_cache.get_or_compute("jorge.spending_means", state, compute)
+
+
+def payment_means_of(state, rollups):
+    def compute():
+        if query_backend is not None:
+            return selection_of(state).means("Purchase_Amount_USD", PAYMENT_GROUPINGS)
+        return rollups.means("payment", PAYMENT_GROUPINGS, state, lambda: payment_mask_of(state))
+
+    return result_cache.get_or_compute("jorge.payment_means", state, compute)
+
+
+# Hypothesis tests of a selection: whether men and women spend differently
+# (Welch's t-test, bootstrap intervals and a permutation test) and whether
+# the category bought depends on gender (chi-square); see hypothesis.py.
+# The tests run on counts: how often each amount was spent per gender, and
+# purchases per gender and category. A query backend counts them in the
+# database, so the rows stay there. Resampling is seeded, so a state always
+# gets the same intervals.
+def hypothesis_tests_of(state):
+    state = base_state(state)
+
+    def compute():
+        male, female = schema.encode("Gender", ["Male", "Female"])
+        n_genders, n_categories = len(schema.LABELS["Gender"]), len(schema.LABELS["Category"])
+        if query_backend is not None:
+            selection = selection_of(state)
+            amounts = selection.counts(["Gender", "Purchase_Amount_USD"])
+            spending = {
+                code: (group["Purchase_Amount_USD"].to_numpy(np.float64), group["n"].to_numpy())
+                for code, group in amounts.groupby("Gender")
+            }
+            cells = selection.counts(["Gender", "Category"])
+            genders_by_category = np.zeros((n_genders, n_categories), dtype=np.int64)
+            genders_by_category[cells["Gender"].to_numpy(np.intp), cells["Category"].to_numpy(np.intp)] = cells["n"].to_numpy()
+        else:
+            rows = shared.frame_at(state["revision"])[["Purchase_Amount_USD", "Gender", "Category"]][filtered_mask_of(state)]
+            gender = rows["Gender"].to_numpy()
+            amounts = rows["Purchase_Amount_USD"].to_numpy(np.float64)
+            spending = {code: value_counts(amounts[gender == code]) for code in (male, female)}
+            genders_by_category = crosstab(gender, rows["Category"].to_numpy(), n_genders, n_categories)
+        no_rows = (np.empty(0), np.empty(0, dtype=np.int64))
+        return {
+            "spending": compare_means(spending.get(male, no_rows), spending.get(female, no_rows)),
+            "category": chi_square(genders_by_category),
+        }
+
+    return result_cache.get_or_compute("jorge.hypothesis_tests", [state, RESAMPLES], compute)
+
+
+def _dollars(amount):
+    return f"{'-' if amount < 0 else ''}${abs(amount):.2f}"
+
+
+def hypothesis_summary(tests):
+    spending, category = tests["spending"], tests["category"]
+    if spending is None:
+        lines = ["Select both genders (or neither) to compare men's and women's spending."]
+    else:
+        (n_male, n_female), (male, female) = spending["n"], spending["means"]
+        lines = [f"Men spent ${male:.2f} on average (n = {n_male:,}) and women ${female:.2f} (n = {n_female:,})."]
+        welch = spending["welch"]
+        if welch is not None:
+            lo, hi = welch["ci"]
+            lines.append(
+                f"Welch t-test: difference {_dollars(welch['diff'])}, 95% CI {_dollars(lo)} to {_dollars(hi)}, "
+                f"t = {welch['t']:.2f}, df = {welch['df']:.0f}, p = {welch['p']:.4f}."
+            )
+        lo, hi = spending["bootstrap"]["diff_ci"]
+        lines.append(
+            f"Bootstrap 95% CI of the difference: {_dollars(lo)} to {_dollars(hi)}; "
+            f"permutation test p = {spending['permutation_p']:.4f} ({spending['resamples']:,} resamples)."
+        )
+    if category is None:
+        lines.append("Gender and category: pick all categories and both genders to test their independence.")
+    else:
+        lines.append(
+            f"Gender and category: chi-square = {category['chi2']:.2f}, df = {category['dof']}, "
+            f"p = {category['p']:.4f}, Cramér's V = {category['cramers_v']:.3f}."
+        )
+        if category["low_expected"] > 0.2:
+            lines.append("Many cells expect fewer than 5 purchases, so the chi-square p-value is approximate.")
+    return " ".join(lines)
+
+
+# Figure builders. Each takes the filtered rows (a query.Selection of them
+# with a query backend) or a table of means, so the sessions and the warm-up
+# build identical figures.
+
+# Age vs spending scatter plot
+def age_vs_spending_figure(filtered_df):
+    # Large selections are sampled per gender; see lod.py
+    return lod_scatter(filtered_df[["Age", "Purchase_Amount_USD", "Gender"]], x="Age", y="Purchase_Amount_USD", color="Gender", title="Age vs Spending")
+
+
+# Gender spending comparison plot
+def gender_spending_figure(means):
+    gender_df = schema.decode_frame(means[("Gender",)].reset_index())
+    return px.bar(gender_df, x="Gender", y="Purchase_Amount_USD", title="Gender Spending Comparison")
+
+
+# Category spending comparison plot
+def category_spending_figure(means):
+    category_df = schema.decode_frame(means[("Category",)].reset_index())
+    return px.bar(category_df, x="Category", y="Purchase_Amount_USD", title="Category Spending Comparison")
+
+
+# Seasonal category heatmap
+def seasonal_category_figure(means):
+    seasonal_category_df = schema.decode_frame(means[("Season", "Category")].unstack())
+
+    # Overall mean across all seasons and categories
+    overall_mean = means[()]
+
+    # Calculate percentage difference from mean
+    diff_from_mean = ((seasonal_category_df - overall_mean) / overall_mean * 100).round(1)
+
+    # Create basic heatmap
+    fig = px.imshow(seasonal_category_df,
+                   title="Seasonal Category Spending Heatmap",
+                   color_continuous_scale=["white", "blue"],
+                   aspect="auto"
+                   )
+
+    # Label the cells with the heatmap's own text, one array for all of them
+    # rather than an annotation each
+    fig.update_traces(
+        text=np.char.mod("%.1f%%", diff_from_mean.to_numpy()),
+        texttemplate="%{text}",
+        textfont=dict(color="black"),
+    )
+
+    return fig
+
+
+# Seasonal spending trends
+def seasonal_trends_figure(means):
+    seasonal_df = schema.decode_frame(means[("Season",)].reset_index())
+    return px.line(seasonal_df, x="Season", y="Purchase_Amount_USD", title="Seasonal Spending Trends")
+
+
+def payment_method_figure(means):
+    # Filtered by the sidebar filters and the selected payment methods;
+    # group by Payment_Method and average the Purchase_Amount_USD
+    payment_df = schema.decode_frame(means[("Payment_Method",)].reset_index())
+
+    # Check if we have any data after filtering
+    if payment_df.empty:
+        return px.pie(title="No data available for the selected filters")
+    return px.pie(payment_df, names="Payment_Method", values="Purchase_Amount_USD",
+                  title="Payment Method Comparison")
+
+
+# Discount/promo impact
+def discount_promo_figure(means):
+    promo_df = schema.decode_frame(means[("Discount_Applied",)].reset_index())
+    return px.bar(promo_df, x="Discount_Applied", y="Purchase_Amount_USD", title="Discount/Promo Impact")
+
+
+# Subscription discount correlation
+def subscription_discount_figure(means):
+    subscription_df = schema.decode_frame(means[("Subscription_Status", "Discount_Applied")].unstack())
+    fig = px.imshow(subscription_df, title="Subscription Status vs Discount Correlation")
+    # Combinations nobody bought with stay blank (NaN isn't valid widget JSON)
+    fig.update_traces(z=subscription_df.astype(object).where(subscription_df.notna(), None).to_numpy().tolist())
+    return fig
+
+
+# Mean spending per gender, with bootstrap intervals
+def hypothesis_figure(tests):
+    spending = tests["spending"]
+    if spending is None:
+        return px.bar(title="Select both genders to compare their spending")
+    means = np.array(spending["means"])
+    intervals = np.array(spending["bootstrap"]["means_ci"])
+    welch = spending["welch"]
+    title = "Mean Spending by Gender (95% bootstrap CI)"
+    if welch is not None:
+        title += f", Welch t-test p-value: {welch['p']:.4f}"
+    return px.bar(
+        x=["Male", "Female"], y=means,
+        error_y=intervals[:, 1] - means, error_y_minus=means - intervals[:, 0],
+        labels={"x": "Gender", "y": "Purchase_Amount_USD"}, title=title,
+    )
+
+
+# Output name -> (what the figure is built from, builder). "rows" are the
+# filtered rows, "spending" and "payment" the tables of means and "tests"
+# the hypothesis tests.
+FIGURES = {
+    "age_vs_spending_scatter": ("rows", age_vs_spending_figure),
+    "gender_spending_comparison": ("spending", gender_spending_figure),
+    "category_spending_comparison": ("spending", category_spending_figure),
+    "seasonal_category_heatmap": ("spending", seasonal_category_figure),
+    "seasonal_spending_trends": ("spending", seasonal_trends_figure),
+    "payment_method_comparison": ("payment", payment_method_figure),
+    "discount_promo_impact": ("spending", discount_promo_figure),
+    "subscription_discount_correlation": ("spending", subscription_discount_figure),
+    "hypothesis_visualization": ("tests", hypothesis_figure),
+}
+
+TEXTS = {
+    "key_findings_summary": "Key findings will be summarized here.",
+    "category_season_insights": "Category and season-related insights will be displayed here.",
+}
+
+# The worker pool jobs behind each tab's outputs (see server())
+TAB_JOBS = {
+    "Overview": ["age_vs_spending_scatter", "gender_spending_comparison", "category_spending_comparison"],
+    "Seasonal and Category Analysis": ["seasonal_category_heatmap", "seasonal_spending_trends"],
+    "Customer Behavior": ["payment_method_comparison", "discount_promo_impact", "subscription_discount_correlation"],
+    "Hypothesis Testing": ["hypothesis_visualization", "hypothesis_tests"],
+}
+
+
+def build_figure(name, state, rollups):
+    """Figure of output `name` for the filters in `state`.
+
+    Built at most once per filter state across all sessions and served from
+    the result cache after that. Doesn't touch reactive values, so it can run
+    on a worker thread.
+    """
+    source, build = FIGURES[name]
+    if source == "payment":
+        data = lambda: payment_means_of(state, rollups)
+    else:
+        state = base_state(state)
+        if source == "rows" and query_backend is not None:
+            data = lambda: selection_of(state)
+        elif source == "rows":
+            data = lambda: shared.frame_at(state["revision"])[filtered_mask_of(state)]
+        elif source == "tests":
+            data = lambda: hypothesis_tests_of(state)
+        else:
+            data = lambda: spending_means_of(state, rollups)
+    return cached_figure(f"jorge.{name}", state, lambda: build(data()))
+
+
+def warm_up(filters=DEFAULT_FILTERS):
+    """Build the tables and figures of `filters` into the result cache.
+
+    Runs without a session, through the same cache keys the sessions use, and
+    pins the results so they're never evicted.
+    """
+    state = selection_state(
+        filters["age_range"], filters["gender"], filters["category"], filters["season"], shared.data_revision
+    )
+    state = with_payment_methods(state, filters["payment_method"])
+    rollups = Rollups()
+    with result_cache.pinned():
+        for name in FIGURES:
+            build_figure(name, state, rollups)
 
-# Handling missing values: Fill NaNs or drop them based on the context
-df.fillna(0, inplace=True)  # Replace NaNs with 0 (or use dropna() if preferred)
 
 # UI Section
 app_ui = ui.page_sidebar(
     ui.sidebar(
         ui.h2("Filters"),
-        ui.input_slider("age_range", "Age Range", min=18, max=80, value=(35, 60)),
-        ui.input_select("category", "Product Category", 
-                        choices=["All", "Accessories", "Clothing", "Footwear", "Outerwear"]),
-        ui.input_select("season", "Season", 
-                        choices=["All", "Spring", "Summer", "Fall", "Winter"]),
-        ui.input_checkbox_group("gender", "Gender", ["Male", "Female"]),
+        ui.input_slider("age_range", "Age Range", min=18, max=80, value=DEFAULT_FILTERS["age_range"]),
+        ui.input_select("category", "Product Category",
+                        choices=["All", "Accessories", "Clothing", "Footwear", "Outerwear"],
+                        selected=DEFAULT_FILTERS["category"]),
+        ui.input_select("season", "Season",
+                        choices=["All", "Spring", "Summer", "Fall", "Winter"],
+                        selected=DEFAULT_FILTERS["season"]),
+        ui.input_checkbox_group("gender", "Gender", ["Male", "Female"], selected=DEFAULT_FILTERS["gender"]),
         ui.input_checkbox_group("payment_method", "Payment Method",
-                                choices=["Credit Card", "Debit Card", "PayPal", "Venmo"]),
+                                choices=["Credit Card", "Debit Card", "PayPal", "Venmo"],
+                                selected=DEFAULT_FILTERS["payment_method"]),
         ui.input_checkbox("show_discounts", "Show Discount/Promo Code Impact"),
     ),
     ui.h2("Shopping Trends Analysis"),
+    # The selected tab is input.tab; see server()
     ui.navset_tab(
-        ui.nav_panel("Overview", 
+        ui.nav_panel("Overview",
             ui.output_text("key_findings_summary"),
             output_widget("age_vs_spending_scatter"),
             output_widget("gender_spending_comparison"),
@@ -44,149 +479,154 @@ app_ui = ui.page_sidebar(
                 output_widget("discount_promo_impact")
             ),
             output_widget("subscription_discount_correlation")
-        ),  
+        ),
+        ui.nav_panel("Hypothesis Testing",
+            ui.output_text("hypothesis_test_results"),
+            output_widget("hypothesis_visualization")
+        ),
+        id="tab",
+        selected="Overview",
     )
 )
 
 # Server Section
 def server(input, output, session):
-    # Apply filters across all graphs
-    def apply_filters(df):
-        # Filter dataset by selected age range
-        filtered_df = df[(df['Age'] >= input.age_range()[0]) & (df['Age'] <= input.age_range()[1])]
-        # Filter by gender
-        if input.gender():
-            filtered_df = filtered_df[filtered_df['Gender'].isin(input.gender())]
-        # Filter by product category
-        if input.category() != "All":
-            filtered_df = filtered_df[filtered_df['Category'] == input.category()]
-        # Filter by season
-        if input.season() != "All":
-            filtered_df = filtered_df[filtered_df['Season'] == input.season()]
-        # Return the filtered dataframe
-        return filtered_df
+    # The range and checkbox filters, passed on once they settle so dragging
+    # the slider or clicking through boxes doesn't rebuild everything for
+    # each intermediate value
+    @debounce(interval("age_range", 0.3))
+    def age_range():
+        return tuple(input.age_range())
+
+    @debounce(interval("gender", 0.15))
+    def gender():
+        return tuple(input.gender())
+
+    @debounce(interval("payment_method", 0.15))
+    def payment_method():
+        return tuple(input.payment_method())
+
+    @reactive.calc
+    def filter_state():
+        # Streamed rows the filters don't select leave the state (and the
+        # outputs) alone; see stream.watch
+        appended_rows()
+        return selection_state(age_range(), gender(), input.category(), input.season(), shared.data_revision)
+
+    appended_rows = watch(filter_state, lambda state: state["revision"], rows_mask)
+
+    @reactive.calc
+    def payment_state():
+        return with_payment_methods(filter_state(), payment_method())
+
+    rollups = Rollups()
+
+    # Each figure is built on the worker pool (see workers.py), from its
+    # filters read here; the payment chart is the only one that depends on
+    # the payment methods
+    def background_figure(name):
+        state = payment_state if FIGURES[name][0] == "payment" else filter_state
+        return BackgroundCalc(build_figure, lambda: (name, state(), rollups))
+
+    jobs = {name: background_figure(name) for name in FIGURES}
+    figures = dict(jobs)
+    if PERSISTENT_WIDGETS:
+        # Each plot keeps its widget and gets patched (see persistent.py)
+        figures = {name: PersistentFigure(name, figure).widget for name, figure in jobs.items()}
+
+    # The tests behind the Hypothesis Testing tab, run on the worker pool too
+    hypothesis_tests = jobs["hypothesis_tests"] = BackgroundCalc(hypothesis_tests_of, lambda: (filter_state(),))
+
+    # Shiny suspends the outputs on tabs (and conditional panels) that aren't
+    # showing: a filter change only marks them stale, and they run when their
+    # tab is opened, usually straight from the result cache. Leaving a tab
+    # also drops its jobs still waiting for a slot, so the tab opened next
+    # gets the session's share of the pool first; they're submitted again if
+    # their tab comes back.
+    @reactive.effect
+    def _skip_hidden_tab_jobs():
+        tab = input.tab()
+        for shown, names in TAB_JOBS.items():
+            if shown != tab:
+                for name in names:
+                    jobs[name].skip_queued()
 
     # Age vs spending scatter plot
     @output
     @render_widget
     def age_vs_spending_scatter():
-        filtered_df = apply_filters(df)
-        fig = px.scatter(filtered_df, x="Age", y="Purchase_Amount_USD", color="Gender", title="Age vs Spending")
-        return fig
+        return figures["age_vs_spending_scatter"]()
 
     # Gender spending comparison plot
     @output
     @render_widget
     def gender_spending_comparison():
-        filtered_df = apply_filters(df)
-        gender_df = filtered_df.groupby("Gender")["Purchase_Amount_USD"].mean().reset_index()
-        fig = px.bar(gender_df, x="Gender", y="Purchase_Amount_USD", title="Gender Spending Comparison")
-        return fig
+        return figures["gender_spending_comparison"]()
 
     # Category spending comparison plot
     @output
     @render_widget
     def category_spending_comparison():
-        filtered_df = apply_filters(df)
-        category_df = filtered_df.groupby("Category")["Purchase_Amount_USD"].mean().reset_index()
-        fig = px.bar(category_df, x="Category", y="Purchase_Amount_USD", title="Category Spending Comparison")
-        return fig
-    
+        return figures["category_spending_comparison"]()
+
 # Seasonal category heatmap
     @output
     @render_widget
     def seasonal_category_heatmap():
-        filtered_df = apply_filters(df)
-        seasonal_category_df = filtered_df.groupby(["Season", "Category"])["Purchase_Amount_USD"].mean().unstack()
-        
-        # Calculate the overall mean across all seasons and categories
-        overall_mean = filtered_df["Purchase_Amount_USD"].mean()
-        
-        # Calculate percentage difference from mean
-        diff_from_mean = ((seasonal_category_df - overall_mean) / overall_mean * 100).round(1)
-        
-        # Create basic heatmap
-        fig = px.imshow(seasonal_category_df,
-                       title="Seasonal Category Spending Heatmap",
-                       color_continuous_scale=["white", "blue"],
-                       aspect="auto"
-                       )
-        
-        # Add annotations
-        for i in range(len(seasonal_category_df.index)):
-            for j in range(len(seasonal_category_df.columns)):
-                fig.add_annotation(
-                    x=j,
-                    y=i,
-                    text=f"{diff_from_mean.iloc[i, j]:.1f}%",
-                    showarrow=False,
-                    font=dict(color="black")
-                )
-        
-        return fig
-    
+        return figures["seasonal_category_heatmap"]()
+
     # Seasonal spending trends
     @output
     @render_widget
     def seasonal_spending_trends():
-        filtered_df = apply_filters(df)
-        seasonal_df = filtered_df.groupby("Season")["Purchase_Amount_USD"].mean().reset_index()
-        fig = px.line(seasonal_df, x="Season", y="Purchase_Amount_USD", title="Seasonal Spending Trends")
-        return fig
+        return figures["seasonal_spending_trends"]()
 
     @output
     @render_widget
     def payment_method_comparison():
-        filtered_df = apply_filters(df)
-        
-        # Filter by selected payment methods
-        if input.payment_method():
-            filtered_df = filtered_df[filtered_df['Payment_Method'].isin(input.payment_method())]
-        
-        # Group by Payment_Method and sum the Purchase_Amount_USD
-        payment_df = filtered_df.groupby("Payment_Method")["Purchase_Amount_USD"].mean().reset_index()
-        
-        # Check if we have any data after filtering
-        if payment_df.empty:
-            fig = px.pie(title="No data available for the selected filters")
-        else:
-            fig = px.pie(payment_df, names="Payment_Method", values="Purchase_Amount_USD", 
-                        title="Payment Method Comparison")
-        
-        return fig
+        return figures["payment_method_comparison"]()
 
 
     # Discount/promo impact
     @output
     @render_widget
     def discount_promo_impact():
-        filtered_df = apply_filters(df)
-        promo_df = filtered_df.groupby("Discount_Applied")["Purchase_Amount_USD"].mean().reset_index()
-        fig = px.bar(promo_df, x="Discount_Applied", y="Purchase_Amount_USD", title="Discount/Promo Impact")
-        return fig
+        return figures["discount_promo_impact"]()
 
     # Subscription discount correlation
     @output
     @render_widget
     def subscription_discount_correlation():
-        filtered_df = apply_filters(df)
-        subscription_df = filtered_df.groupby(["Subscription_Status", "Discount_Applied"])["Purchase_Amount_USD"].mean().unstack()
-        fig = px.imshow(subscription_df, title="Subscription Status vs Discount Correlation")
-        return fig
+        return figures["subscription_discount_correlation"]()
+
+    # Hypothesis test results summary
+    @output
+    @render.text
+    def hypothesis_test_results():
+        return hypothesis_summary(hypothesis_tests())
+
+    # Mean spending by gender, with its intervals
+    @output
+    @render_widget
+    def hypothesis_visualization():
+        return figures["hypothesis_visualization"]()
 
     # Key findings summary
     @output
     @render.text
     def key_findings_summary():
-        return "Key findings will be summarized here."
+        return TEXTS["key_findings_summary"]
 
     # Category season insights
     @output
     @render.text
     def category_season_insights():
-        return "Category and season-related insights will be displayed here."
+        return TEXTS["category_season_insights"]
+
 
+if warm_up_on_load:
+    warm_up()
 
-# Create the Shiny app
-app = App(app_ui, server)
+# Create the Shiny app, with /metrics next to it when SHINY_METRICS=1 (see metrics.py)
+app = with_metrics(App(app_ui, server))
 
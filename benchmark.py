@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Times what each output of both dashboards computes, on synthetic copies of
+# the dataset at production sizes, and writes latency percentiles and peak
+# memory as JSON that can be diffed between versions:
+#
+#   python benchmark.py                          # 10k, 1M and 10M rows
+#   python benchmark.py --sizes 10k 1M --repeat 10 --output before.json
+#   python benchmark.py --compare before.json --output after.json
+#   python benchmark.py --backend sqlite         # through query.py instead
+#
+# Every size runs in its own process (the dataset loads at import, see
+# shared.py), with the result cache cleared before each timed call so every
+# number is a cold build, as for the first session asking for that state.
+
+app_dir = Path(__file__).parent
+SOURCE_CSV = app_dir / "Data" / "shopping_trends_imputed.csv"
+SIZES = {"10k": 10_000, "1M": 1_000_000, "10M": 10_000_000}
+
+# Sidebar states of the core app (app_Jorge_Merged_version.py)
+JORGE_STATES = {
+    "default": ((35, 60), [], "All", "All", []),
+    "everything": ((18, 80), [], "All", "All", []),
+    "one_gender_category": ((18, 80), ["Male"], "Clothing", "All", ["Credit Card", "Debit Card"]),
+    "narrow": ((30, 35), ["Female"], "Footwear", "Winter", ["PayPal"]),
+}
+# Sidebar states of the express app (app.py): bill range (None for the full
+# range) and genders
+APP_STATES = {
+    "everything": (None, ["Male", "Female"]),
+    "female": (None, ["Female"]),
+    "mid_bills": ((40, 80), ["Male", "Female"]),
+}
+# Table views: (filter column, filter text, sort column, descending) and page
+TABLE_VIEWS = {
+    "first_page": (("", "", "", False), 1),
+    "sorted_deep_page": (("", "", "Age", True), 50),
+    "filtered_sorted": (("Location", "new", "Purchase_Amount_USD", False), 1),
+}
+
+
+def synthetic_chunks(n_rows, seed=0, chunk_rows=1_000_000):
+    """Frames of `n_rows` rows in all with the bundled CSV's columns.
+
+    Each column is drawn from that column's own value distribution in the
+    CSV, so it keeps its values and cardinality (50 locations, 25 items, ages
+    18 to 70...). Customer_ID counts up from 1.
+    """
+    source = pd.read_csv(SOURCE_CSV)
+    rng = np.random.default_rng(seed)
+    distributions = {col: source[col].value_counts(normalize=True) for col in source.columns if col != "Customer_ID"}
+    for start in range(0, n_rows, chunk_rows):
+        size = min(chunk_rows, n_rows - start)
+        chunk = {"Customer_ID": np.arange(start + 1, start + size + 1)}
+        for col, freq in distributions.items():
+            chunk[col] = rng.choice(freq.index.to_numpy(), size=size, p=freq.to_numpy())
+        yield pd.DataFrame(chunk)[source.columns]
+
+
+def synthetic_csv(n_rows, data_dir, seed=0):
+    """Path of a synthetic CSV of `n_rows` rows in `data_dir`, written if it's missing."""
+    path = Path(data_dir) / f"synthetic-{n_rows}-{seed}.csv"
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        for i, chunk in enumerate(synthetic_chunks(n_rows, seed)):
+            chunk.to_csv(tmp, mode="w" if i == 0 else "a", header=i == 0, index=False)
+        os.replace(tmp, path)
+    return path
+
+
+def percentiles(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p90_ms": round(float(np.percentile(ms, 90)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+
+def _cases():
+    # (app, case, state, call) for every output and state; imported here so
+    # the dataset loads in the child process only
+    import app_Jorge_Merged_version as jorge
+    import dashboard
+    import schema
+    import shared
+
+    cases = []
+    for label, (age_range, gender, category, season, payment) in JORGE_STATES.items():
+        state = jorge.with_payment_methods(
+            jorge.selection_state(age_range, gender, category, season, shared.data_revision), payment
+        )
+        if shared.query_backend is None:
+            cases.append(("jorge", "filter", label, lambda state=state: jorge.filtered_mask_of(state)))
+        cases.append(("jorge", "spending_means", label, lambda state=state: jorge.spending_means_of(state, jorge.Rollups())))
+        cases.append(("jorge", "payment_means", label, lambda state=state: jorge.payment_means_of(state, jorge.Rollups())))
+        for name in jorge.FIGURES:
+            cases.append(("jorge", name, label, lambda state=state, name=name: jorge.build_figure(name, state, jorge.Rollups())))
+
+    for label, (bill, genders) in APP_STATES.items():
+        state = (bill or dashboard.purchase_range, tuple(schema.encode("Gender", genders)), shared.data_revision)
+        if shared.query_backend is None:
+            cases.append(("app", "filter", label, lambda state=state: dashboard.filter_mask_of(state)))
+        cases.append(("app", "bill_summary", label, lambda state=state: dashboard.bill_summary_of(state)))
+        for color in ["None", "Gender", "Location"]:
+            cases.append(("app", f"scatterplot[{color}]", label, lambda state=state, color=color: dashboard.scatter_figure(state, color)))
+        for yvar in ["Season", "Location"]:
+            cases.append(("app", f"tip_perc[{yvar}]", label, lambda state=state, yvar=yvar: dashboard.ridge_figure(state, yvar)))
+        for view, (table_state, page) in TABLE_VIEWS.items():
+            cases.append((
+                "app", f"table[{view}]", label,
+                lambda state=state, table_state=table_state, page=page: dashboard.table_pager_of(state, table_state).page(page),
+            ))
+    return cases
+
+
+def _payload_bytes(value):
+    # Size of what goes to the browser for figures and table pages
+    import plotly.graph_objects as go
+
+    from transport import figure_json
+
+    if isinstance(value, go.Figure):
+        return len(figure_json(value))
+    if isinstance(value, pd.DataFrame):
+        return len(value.to_json(orient="values"))
+    return None
+
+
+def run(repeat):
+    """Time every case in this process; returns the results for one size."""
+    start = time.perf_counter()
+    from result_cache import result_cache
+    import shared
+
+    load_seconds = time.perf_counter() - start
+    results = []
+    for app, case, state, call in _cases():
+        seconds = []
+        for _ in range(repeat):
+            result_cache.clear()
+            t0 = time.perf_counter()
+            value = call()
+            seconds.append(time.perf_counter() - t0)
+        # Allocations are traced in a separate run, as tracing slows things down
+        result_cache.clear()
+        tracemalloc.start()
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append({
+            "app": app,
+            "case": case,
+            "state": state,
+            **percentiles(seconds),
+            "peak_alloc_mb": round(peak / 2**20, 2),
+            "payload_bytes": _payload_bytes(value),
+        })
+        print(f"  {app} {case} [{state}]: p50 {results[-1]['p50_ms']} ms", file=sys.stderr)
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "rows": int(shared.rows_at(shared.data_revision)) if shared.query_backend is None else None,
+        "load_seconds": round(load_seconds, 3),
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        "max_rss_mb": round(max_rss / (2**20 if sys.platform == "darwin" else 2**10), 1),
+        "cases": results,
+    }
+
+
+def _run_size(label, n_rows, args):
+    csv = synthetic_csv(n_rows, args.data_dir, args.seed)
+    env = dict(
+        os.environ,
+        SHINY_DATASET=str(csv),
+        SHINY_SNAPSHOT_DIR=str(Path(args.data_dir) / "snapshots"),
+        SHINY_WARM_UP="0",
+    )
+    env.pop("SHINY_QUERY_SOURCE", None)
+    if args.backend:
+        import query
+
+        source = Path(args.data_dir) / f"{csv.stem}.{'db' if args.backend == 'sqlite' else 'parquet'}"
+        if not source.exists():
+            query.build(csv, source)
+        env["SHINY_QUERY_SOURCE"] = str(source)
+    print(f"{label} rows ({csv})", file=sys.stderr)
+    result = Path(args.data_dir) / f"result-{os.getpid()}.json"
+    subprocess.run([sys.executable, __file__, "--run", str(result), "--repeat", str(args.repeat)], env=env, cwd=app_dir, check=True)
+    try:
+        return {"size": label, "n_rows": n_rows, **json.loads(result.read_text())}
+    finally:
+        result.unlink()
+
+
+def compare(baseline, current):
+    """Print the p50 change of every case found in both result files."""
+    def index(report):
+        return {
+            (size["size"], case["app"], case["case"], case["state"]): case
+            for size in report["sizes"]
+            for case in size["cases"]
+        }
+
+    before, after = index(baseline), index(current)
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key]["p50_ms"], after[key]["p50_ms"]
+        change = (new - old) / old * 100 if old else float("nan")
+        print(f"{' '.join(key):<70} {old:>10.2f} -> {new:>10.2f} ms  {change:+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dashboards' outputs on synthetic data.")
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES), help=f"dataset sizes, of {', '.join(SIZES)} or row counts")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case and state")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=["sqlite", "duckdb"], help="query the data through query.py")
+    parser.add_argument("--data-dir", default=app_dir / ".benchmarks", help="where synthetic datasets are kept")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="earlier output to print p50 changes against")
+    # Set by _run_size() for the process timing one size
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        Path(args.run).write_text(json.dumps(run(args.repeat)))
+        return
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": subprocess.run(["git", "rev-parse", "HEAD"], cwd=app_dir, capture_output=True, text=True).stdout.strip() or None,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "cpus": os.cpu_count(),
+            "machine": platform.machine(),
+            "repeat": args.repeat,
+            "backend": args.backend,
+        },
+        "sizes": [_run_size(size, SIZES.get(size) or int(size), args) for size in args.sizes],
+    }
+    Path(args.output).write_text(json.dumps(report, indent=1))
+    print(f"Wrote {args.output}", file=sys.stderr)
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), report)
+
+
+if __name__ == "__main__":
+    main()
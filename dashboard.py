@@ -0,0 +1,142 @@
+from ridgeplot import ridgeplot
+
+import schema
+import shared
+from density import ridge_densities, selection_ridge_densities
+from lod import lod_scatter
+from paging import Pager, QueryPager, column_filter, column_filter_mask, ordered_rows
+from query import name, ratio
+from result_cache import cached_figure, cached_mask, result_cache
+from shared import query_backend, use_filter_index
+from trendline import add_trendlines, trendlines
+
+# The data behind the express dashboard (app.py). None of it reads reactive
+# values, so it can run on a worker thread or without a session at all, e.g.
+# in benchmark.py. A state is (bill range, gender codes, data revision), as
+# app.py's filter_state() makes it; results are shared between sessions
+# through the result cache under it.
+
+if query_backend is None:
+    purchase_range = (int(shared.shopping_trends.Purchase_Amount_USD.min()), int(shared.shopping_trends.Purchase_Amount_USD.max()))
+else:
+    purchase_range = tuple(int(v) for v in query_backend.select().bounds(name("Purchase_Amount_USD")))
+table_columns = list(shared.shopping_trends.columns)
+
+
+def rows_mask(state, rows):
+    bill, genders, _ = state
+    idx1 = rows.Purchase_Amount_USD.between(bill[0], bill[1])
+    idx2 = rows.Gender.isin(genders) # updated Age -> Gender because this filter should match what's on the left side
+    return (idx1 & idx2).to_numpy()
+
+
+def filter_mask_of(state):
+    bill, genders, revision = state
+
+    def compute():
+        if use_filter_index:
+            return shared.filter_index.mask(
+                ranges={"Purchase_Amount_USD": bill},
+                values={"Gender": genders},
+            )[:shared.rows_at(revision)]
+        return rows_mask(state, shared.frame_at(revision))
+
+    # Shared by every session with the same filters
+    return cached_mask("app.filter_mask", state, compute)
+
+
+def selection_of(state):
+    # The filters as a query on the backend (see query.py)
+    bill, genders, _ = state
+    return query_backend.select(ranges={"Purchase_Amount_USD": bill}, values={"Gender": genders})
+
+
+def bill_summary_of(state):
+    # Rows selected and their mean bill
+    def compute():
+        if query_backend is not None:
+            return selection_of(state).summary("Purchase_Amount_USD")
+        bills = shared.frame_at(state[2]).Purchase_Amount_USD.to_numpy()[filter_mask_of(state)]
+        return len(bills), bills.mean() if len(bills) else float("nan")
+
+    return result_cache.get_or_compute("app.bill_summary", state, compute)
+
+
+def table_pager_of(state, table_state):
+    # Filtered rows in the table's sort order; paging through them only slices.
+    # `table_state` is (filter column, filter text, sort column, descending).
+    filter_col, filter_text, sort, descending = table_state
+    if query_backend is not None:
+        # The database sorts and pages instead
+        selection = selection_of(state)
+        spec = column_filter(filter_col, filter_text)
+        if spec is not None:
+            selection = selection.narrowed(*spec)
+        return QueryPager(selection, sort, descending)
+
+    frame = shared.frame_at(state[2])
+
+    def positions():
+        mask = filter_mask_of(state)
+        column_mask = column_filter_mask(frame, filter_col, filter_text)
+        if column_mask is not None:
+            mask = mask & column_mask
+        return ordered_rows(frame, mask, sort, descending)
+
+    rows = result_cache.get_or_compute("app.table_rows", (state, table_state), positions)
+    return Pager(frame, rows)
+
+
+def scatter_figure(state, color):
+    color = None if color == "None" else color # updated none -> None to match what was listed
+
+    def build():
+        rows = selection_of(state) if query_backend is not None else shared.frame_at(state[2])[filter_mask_of(state)]
+        dat = rows[["Purchase_Amount_USD", "Age"] + ([color] if color else [])]
+        # Bins or samples large selections; see lod.py
+        fig = lod_scatter(dat, x="Purchase_Amount_USD", y="Age", color=color)
+        # LOWESS over all the selected rows, cached per filter state and color
+        lines = trendlines(dat, "Purchase_Amount_USD", "Age", color, key=(state, color))
+        return add_trendlines(fig, lines)
+
+    return cached_figure("app.scatterplot", (state, color), build)
+
+
+def ridge_figure(state, yvar):
+    def build():
+        if query_backend is not None:
+            # Binned in the database; None when no rows match
+            densities = selection_ridge_densities(
+                selection_of(state), ratio("Previous_Purchases", "Purchase_Amount_USD"), yvar, bandwidth=0.01, key=(state, yvar)
+            )
+            if densities is None:
+                return None
+            codes, densities = densities
+        else:
+            dat = shared.frame_at(state[2])[filter_mask_of(state)]
+            if dat.shape[0] == 0:
+                return None
+
+            # Computed on plain arrays, leaving the shared frame untouched
+            percent = dat.Previous_Purchases.to_numpy() / dat.Purchase_Amount_USD.to_numpy() # dat.tip -> dat.Previous_Purchases
+            # All groups' densities in one pass, cached per filter state and split variable
+            codes, densities = ridge_densities(
+                percent, dat[yvar].to_numpy(), bandwidth=0.01, key=(state, yvar)
+            )
+
+        plt = ridgeplot(
+            densities=densities,
+            labels=list(schema.decode(yvar, codes)),
+            colorscale="viridis",
+            colormode="row-index",
+        )
+
+        plt.update_layout(
+            legend=dict(
+                orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5
+            )
+        )
+
+        return plt
+
+    return cached_figure("app.tip_perc", (state, yvar), build)
@@ -0,0 +1,107 @@
+import numpy as np
+
+from result_cache import result_cache
+
+# Values are counted into KDE_BINS fine bins before smoothing, and densities
+# are read off at KDE_POINTS of them
+KDE_BINS = 2048
+KDE_POINTS = 512
+
+
+def grouped_kde(values, groups, n_groups, bandwidth, bins=KDE_BINS, points=KDE_POINTS):
+    """Gaussian KDE of `values` within each of `n_groups` integer `groups`.
+
+    All groups are binned with bincounts on (group, bin) and smoothed
+    together with one batched FFT convolution, so the cost is linear in the
+    values plus a fixed amount per group. Returns the shared x grid and an
+    (n_groups, points) array of densities; empty groups are all zeros.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    lo, width = kde_grid(values.min(), values.max(), bandwidth, bins)
+    counts = linear_bin_counts(values, groups, n_groups, lo, width, bins)
+    return smooth_counts(counts, lo, width, bandwidth, points)
+
+
+def kde_grid(low, high, bandwidth, bins=KDE_BINS):
+    """(start, width) of the fine bins for values from `low` to `high`."""
+    lo = low - 4 * bandwidth
+    hi = high + 4 * bandwidth
+    return lo, (hi - lo) / bins
+
+
+def linear_bin_counts(values, groups, n_groups, lo, width, bins=KDE_BINS):
+    """(n_groups, bins) array of `values` counted into the fine bins per group.
+
+    Linear binning: each value is split between the two nearest bin centres.
+    """
+    position = (values - lo) / width - 0.5
+    left = np.clip(np.floor(position).astype(np.intp), 0, bins - 2)
+    right_share = np.clip(position - left, 0, 1)
+    flat = groups * bins + left
+    counts = np.bincount(flat, weights=1 - right_share, minlength=n_groups * bins)
+    counts += np.bincount(flat + 1, weights=right_share, minlength=n_groups * bins)
+    return counts.reshape(n_groups, bins)
+
+
+def smooth_counts(counts, lo, width, bandwidth, points=KDE_POINTS):
+    """Densities from fine-bin counts, as `grouped_kde` returns them."""
+    bins = counts.shape[1]
+    # Zero-padded FFT convolution with a Gaussian sampled on the bin grid
+    half = int(np.ceil(4 * bandwidth / width))
+    size = 1 << int(np.ceil(np.log2(bins + 2 * half + 1)))
+    offsets = np.arange(-half, half + 1)
+    kernel = np.zeros(size)
+    kernel[offsets % size] = np.exp(-0.5 * (offsets * width / bandwidth) ** 2)
+    kernel /= kernel.sum()
+    smoothed = np.fft.irfft(np.fft.rfft(counts, size, axis=1) * np.fft.rfft(kernel), size, axis=1)[:, :bins]
+
+    totals = counts.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        density = np.where(totals > 0, np.clip(smoothed, 0, None) / (totals * width), 0.0)
+
+    step = max(bins // points, 1)
+    grid = lo + (np.arange(bins) + 0.5) * width
+    return grid[::step], density[:, ::step]
+
+
+def ridge_densities(values, groups, bandwidth, key=None):
+    """Per-group densities of `values` laid out for `ridgeplot(densities=...)`.
+
+    `groups` are non-negative integer codes. Returns the codes that occur, in
+    order, and a (rows, 1, points, 2) array of (x, density) pairs, one row per
+    code. When `key` is given (say the filter state and split variable),
+    results are shared between sessions through the result cache.
+    """
+    if key is not None:
+        return result_cache.get_or_compute("ridge_densities", [key, bandwidth], lambda: ridge_densities(values, groups, bandwidth))
+
+    groups = np.asarray(groups, dtype=np.intp)
+    present = np.flatnonzero(np.bincount(groups))
+    grid, density = grouped_kde(values, groups, present[-1] + 1, bandwidth)
+    return _ridge_layout(present, grid, density[present])
+
+
+def selection_ridge_densities(selection, value, group, bandwidth, key=None):
+    """`ridge_densities` of the SQL expression `value` per `group` over a `query.Selection`.
+
+    The fine-bin counts are made in the database, so only those come back.
+    Returns None if the selection is empty.
+    """
+    if key is not None:
+        return result_cache.get_or_compute(
+            "ridge_densities", [key, value, bandwidth], lambda: selection_ridge_densities(selection, value, group, bandwidth)
+        )
+
+    bounds = selection.bounds(value)
+    if bounds is None:
+        return None
+    lo, width = kde_grid(*bounds, bandwidth)
+    counts = selection.linear_bins(value, group, lo, width, KDE_BINS)
+    present = np.flatnonzero(counts.sum(axis=1) > 0)
+    grid, density = smooth_counts(counts, lo, width, bandwidth)
+    return _ridge_layout(present, grid, density[present])
+
+
+def _ridge_layout(present, grid, density):
+    xy = np.stack([np.broadcast_to(grid, density.shape), density], axis=-1)
+    return present, xy[:, None]
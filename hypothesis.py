@@ -0,0 +1,230 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import stats
+
+# Resamples drawn for bootstrap intervals and permutation tests
+RESAMPLES = int(os.environ.get("SHINY_RESAMPLES", "2000"))
+# Resamples are drawn a batch at a time, as one (batch, rows) matrix of at
+# most this many MB
+RESAMPLE_BATCH_MB = float(os.environ.get("SHINY_RESAMPLE_BATCH_MB", "64"))
+# Set SHINY_RESAMPLE_PROCESSES to spread resamples over that many processes;
+# worth it for selections of hundreds of thousands of rows
+RESAMPLE_PROCESSES = int(os.environ.get("SHINY_RESAMPLE_PROCESSES", "0"))
+CONFIDENCE = 0.95
+
+# Per process, as forked workers (see serve.py) can't use their parent's
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def value_counts(values):
+    """`values` as a sample: (distinct values, how often each occurs).
+
+    The tests take samples in this form, so a database can count them
+    rather than send the rows.
+    """
+    return np.unique(np.asarray(values, dtype=np.float64), return_counts=True)
+
+
+def _sample(sample):
+    values, counts = sample
+    return np.asarray(values, dtype=np.float64), np.asarray(counts, dtype=np.int64)
+
+
+def _moments(sample):
+    # (size, mean, variance with n - 1 degrees of freedom) of a sample
+    values, counts = _sample(sample)
+    n = int(counts.sum())
+    mean = counts @ values / n if n else np.nan
+    var = counts @ (values - mean) ** 2 / (n - 1) if n > 1 else np.nan
+    return n, mean, var
+
+
+def welch_ttest(a, b, confidence=CONFIDENCE):
+    """Welch's t-test of mean(a) == mean(b), with an interval for the difference.
+
+    `a` and `b` are samples (see `value_counts()`). None when either has
+    fewer than two values or neither varies.
+    """
+    (n_a, mean_a, var_a), (n_b, mean_b, var_b) = _moments(a), _moments(b)
+    if n_a < 2 or n_b < 2:
+        return None
+    se2_a, se2_b = var_a / n_a, var_b / n_b
+    se = np.sqrt(se2_a + se2_b)
+    if se == 0:
+        return None
+    diff = mean_a - mean_b
+    t = diff / se
+    # Welch-Satterthwaite degrees of freedom
+    df = (se2_a + se2_b) ** 2 / (se2_a**2 / (n_a - 1) + se2_b**2 / (n_b - 1))
+    margin = stats.t.ppf(0.5 + confidence / 2, df) * se
+    return {
+        "diff": float(diff),
+        "t": float(t),
+        "df": float(df),
+        "p": float(2 * stats.t.sf(abs(t), df)),
+        "ci": (float(diff - margin), float(diff + margin)),
+    }
+
+
+def crosstab(a, b, n_a, n_b):
+    """(n_a, n_b) table of how often each pair of integer codes occurs."""
+    return np.bincount(np.asarray(a, dtype=np.intp) * n_b + b, minlength=n_a * n_b).reshape(n_a, n_b)
+
+
+def chi_square(table):
+    """Chi-square test of independence of a contingency table's rows and columns.
+
+    Rows and columns without counts are left out; None when fewer than two of
+    either remain. Like `scipy.stats.chi2_contingency`, a 2x2 table gets
+    Yates' continuity correction; Cramér's V is from the uncorrected
+    statistic. `low_expected` is the share of cells expecting fewer than
+    five counts, above about 0.2 of which the p-value is unreliable.
+    """
+    table = np.asarray(table, dtype=np.float64)
+    table = table[table.sum(axis=1) > 0][:, table.sum(axis=0) > 0]
+    if min(table.shape) < 2:
+        return None
+    n = table.sum()
+    expected = np.outer(table.sum(axis=1), table.sum(axis=0)) / n
+    chi2 = ((table - expected) ** 2 / expected).sum()
+    dof = (table.shape[0] - 1) * (table.shape[1] - 1)
+    statistic = chi2
+    if dof == 1:
+        # Each count moved up to 0.5 towards its expected count
+        gap = np.maximum(np.abs(table - expected) - 0.5, 0)
+        statistic = (gap**2 / expected).sum()
+    return {
+        "chi2": float(statistic),
+        "dof": int(dof),
+        "p": float(stats.chi2.sf(statistic, dof)),
+        "cramers_v": float(np.sqrt(chi2 / (n * (min(table.shape) - 1)))),
+        "low_expected": float((expected < 5).mean()),
+    }
+
+
+def _batches(resamples, width):
+    # Batch sizes adding up to `resamples`, each (batch, width) matrix within
+    # RESAMPLE_BATCH_MB (indices and gathered values take 16 bytes per entry)
+    size = max(1, min(resamples, int(RESAMPLE_BATCH_MB * 2**20) // (16 * max(width, 1))))
+    full, rest = divmod(resamples, size)
+    return [size] * full + ([rest] if rest else [])
+
+
+def _few_distinct(values, n):
+    # Whether to resample how often each value is picked rather than rows
+    return len(values) * 4 <= n
+
+
+def bootstrap_means(sample, resamples, seed):
+    """Means of `resamples` bootstrap resamples of `sample` (see `value_counts()`).
+
+    With few distinct values (like whole-dollar amounts) each batch draws
+    how often each value is picked, as a (batch, distinct values)
+    multinomial matrix. Otherwise it draws a (batch, rows) matrix of row
+    indices and takes the mean of every row of it at once; it's the same
+    distribution either way.
+    """
+    values, counts = _sample(sample)
+    n = int(counts.sum())
+    rng = np.random.default_rng(seed)
+    if _few_distinct(values, n):
+        means = [rng.multinomial(n, counts / n, size=batch) @ values / n for batch in _batches(resamples, len(values))]
+    else:
+        rows = np.repeat(values, counts)
+        means = [rows[rng.integers(0, n, size=(batch, n))].mean(axis=1) for batch in _batches(resamples, n)]
+    return np.concatenate(means) if means else np.empty(0)
+
+
+def permutation_diffs(a, b, resamples, seed):
+    """mean(a) - mean(b) over `resamples` random relabellings of the pooled samples.
+
+    With few distinct values, each batch draws how many of each land in `a`
+    from the multivariate hypergeometric distribution. Otherwise it
+    shuffles every row of a (batch, pooled rows) matrix independently and
+    splits the rows at the size of `a`.
+    """
+    values_a, counts_a = _sample(a)
+    values_b, counts_b = _sample(b)
+    values, inverse = np.unique(np.concatenate([values_a, values_b]), return_inverse=True)
+    counts = np.bincount(inverse, np.concatenate([counts_a, counts_b]), minlength=len(values)).astype(np.int64)
+    n_a, n_b = int(counts_a.sum()), int(counts_b.sum())
+    total = counts @ values
+    rng = np.random.default_rng(seed)
+    sums = []
+    if _few_distinct(values, n_a + n_b):
+        for batch in _batches(resamples, len(values)):
+            sums.append(rng.multivariate_hypergeometric(counts, n_a, size=batch) @ values)
+    else:
+        pooled = np.repeat(values, counts)
+        for batch in _batches(resamples, len(pooled)):
+            shuffled = rng.permuted(np.broadcast_to(pooled, (batch, len(pooled))), axis=1)
+            sums.append(shuffled[:, :n_a].sum(axis=1))
+    sum_a = np.concatenate(sums) if sums else np.empty(0)
+    return sum_a / n_a - (total - sum_a) / n_b
+
+
+def _process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool[0] != os.getpid():
+            # A fresh server process rather than a fork of this threaded one
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = (os.getpid(), ProcessPoolExecutor(RESAMPLE_PROCESSES, mp_context=multiprocessing.get_context(method)))
+        return _pool[1]
+
+
+def resample(kernel, data, resamples=RESAMPLES, seed=0):
+    """`kernel(*data, resamples, seed)`, split over the process pool if there is one.
+
+    Each process gets its share of the resamples and its own independent
+    stream of random numbers; the results are concatenated in order, so
+    they're the same for a given seed and number of processes.
+    """
+    if RESAMPLE_PROCESSES <= 1:
+        return kernel(*data, resamples, seed)
+    shares = [len(part) for part in np.array_split(np.arange(resamples), RESAMPLE_PROCESSES)]
+    seeds = (seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)).spawn(len(shares))
+    pool = _process_pool()
+    jobs = [pool.submit(kernel, *data, share, s) for share, s in zip(shares, seeds) if share]
+    return np.concatenate([job.result() for job in jobs])
+
+
+def percentile_interval(draws, confidence=CONFIDENCE):
+    """The central `confidence` interval of bootstrap `draws`."""
+    lo, hi = np.percentile(draws, [50 * (1 - confidence), 50 * (1 + confidence)])
+    return float(lo), float(hi)
+
+
+def compare_means(a, b, resamples=RESAMPLES, seed=0):
+    """How the means of samples `a` and `b` (see `value_counts()`) differ, three ways.
+
+    Welch's t-test; bootstrap percentile intervals for each mean and for
+    their difference, resampling each sample on its own; and a permutation
+    test of the difference. None when either sample has fewer than two values.
+    """
+    a, b = _sample(a), _sample(b)
+    (n_a, mean_a, _), (n_b, mean_b, _) = _moments(a), _moments(b)
+    if n_a < 2 or n_b < 2:
+        return None
+    seed_a, seed_b, seed_perm = np.random.SeedSequence(seed).spawn(3)
+    boot_a = resample(bootstrap_means, (a,), resamples, seed_a)
+    boot_b = resample(bootstrap_means, (b,), resamples, seed_b)
+    diffs = resample(permutation_diffs, (a, b), resamples, seed_perm)
+    observed = mean_a - mean_b
+    return {
+        "n": (n_a, n_b),
+        "means": (float(mean_a), float(mean_b)),
+        "welch": welch_ttest(a, b),
+        "bootstrap": {
+            "means_ci": (percentile_interval(boot_a), percentile_interval(boot_b)),
+            "diff_ci": percentile_interval(boot_a - boot_b),
+        },
+        # Two-sided, counting the observed labelling as one of the resamples
+        "permutation_p": float((1 + np.count_nonzero(np.abs(diffs) >= abs(observed) * (1 - 1e-9))) / (1 + len(diffs))),
+        "resamples": resamples,
+    }
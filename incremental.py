@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+
+class IncrementalRollup:
+    """Running per-group sums and counts over a changing selection of facts.
+
+    Facts are either dataset rows or spending cube cells: a code per dimension
+    plus a sum and a count each. `update()` takes the new selection mask and
+    applies only the facts that entered or left it, so nudging a slider costs
+    time proportional to the band of facts that changed, not to the selection.
+    Keep one instance per session and selection.
+    """
+
+    def __init__(self, keys, sums, counts, groupings, name=None):
+        self.name = name
+        self.sums = np.asarray(sums, dtype=np.float64)
+        self.counts = np.asarray(counts, dtype=np.float64)
+        self.mask = np.zeros(len(self.sums), dtype=bool)
+
+        # Flat group id of every fact for each grouping, and its accumulators
+        self._groups = {}
+        for by in groupings:
+            by = tuple(by)
+            sizes = tuple(int(keys[dim].max()) + 1 if len(keys[dim]) else 1 for dim in by)
+            ids = np.ravel_multi_index([np.asarray(keys[dim], dtype=np.intp) for dim in by], sizes)
+            n_groups = int(np.prod(sizes))
+            self._groups[by] = (ids, sizes, np.zeros(n_groups), np.zeros(n_groups))
+
+    @classmethod
+    def from_cube(cls, cube, groupings):
+        return cls(cube.cells, cube.sums, cube.counts, groupings, name=cube.measure)
+
+    @classmethod
+    def from_rows(cls, df, measure, groupings):
+        keys = {dim: df[dim].to_numpy() for by in groupings for dim in by}
+        return cls(keys, df[measure].to_numpy(), np.ones(len(df)), groupings, name=measure)
+
+    def update(self, mask):
+        """Move the selection to `mask`, applying only the facts that changed."""
+        changed = mask ^ self.mask
+        n_changed = np.count_nonzero(changed)
+        if n_changed == 0:
+            return self
+        if n_changed > np.count_nonzero(mask):
+            # Cheaper to rebuild from the new selection than to apply the delta
+            positions = np.flatnonzero(mask)
+            signs = np.ones(len(positions))
+            for _, _, sums, counts in self._groups.values():
+                sums[:] = 0
+                counts[:] = 0
+        else:
+            positions = np.flatnonzero(changed)
+            signs = np.where(mask[positions], 1.0, -1.0)
+
+        weighted_sums = signs * self.sums[positions]
+        weighted_counts = signs * self.counts[positions]
+        for ids, _, sums, counts in self._groups.values():
+            group_ids = ids[positions]
+            sums += np.bincount(group_ids, weights=weighted_sums, minlength=len(sums))
+            counts += np.bincount(group_ids, weights=weighted_counts, minlength=len(counts))
+        self.mask = mask.copy()
+        return self
+
+    def mean(self, by):
+        """Mean of the measure per `by` group over the selected facts."""
+        _, sizes, sums, counts = self._groups[tuple(by)]
+        present = np.flatnonzero(counts > 0.5)
+        codes = np.unravel_index(present, sizes)
+        if len(by) == 1:
+            index = pd.Index(codes[0], name=by[0])
+        else:
+            index = pd.MultiIndex.from_arrays(codes, names=list(by))
+        return pd.Series(sums[present] / counts[present], index=index, name=self.name)
+
+    def overall_mean(self):
+        """Mean of the measure over all selected facts (NaN if there are none)."""
+        # Every grouping partitions the selection, so any one has the totals
+        _, _, sums, counts = next(iter(self._groups.values()))
+        count = counts.sum()
+        return sums.sum() / count if count > 0.5 else np.nan
@@ -0,0 +1,387 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import websockets
+except ImportError:  # Only the load test needs it; see requirements-dev.txt
+    sys.exit("loadtest.py needs the websockets package: pip install -r requirements-dev.txt")
+
+# Finds how many simultaneous users one server process of the core app
+# (app_Jorge_Merged_version.py) can hold. For each number of sessions it
+# starts the app under uvicorn, opens that many websocket sessions and has
+# each replay a user script (dragging the age slider, switching tabs, ticking
+# checkboxes...) with think time in between, then reports how long outputs
+# took to update, the updates served per second and the server's CPU and
+# memory per session:
+#
+#   python loadtest.py                                  # 1 to 64 sessions
+#   python loadtest.py --sessions 8 16 32 --duration 60 --output loadtest.json
+#
+# Sessions wait for their last update before sending the next, as people do,
+# so past the point where the server is saturated more sessions only make
+# each update slower. That point, the throughput knee, is printed at the end.
+# Set SHINY_* variables as for the app itself to load-test other settings.
+# Needs the packages in requirements-dev.txt on top of requirements.txt.
+
+app_dir = Path(__file__).parent
+
+# Outputs on each tab of the core app; a tab switch hides one set and shows another
+TABS = {
+    "Overview": ["key_findings_summary", "age_vs_spending_scatter", "gender_spending_comparison", "category_spending_comparison"],
+    "Seasonal and Category Analysis": ["seasonal_category_heatmap", "seasonal_spending_trends", "category_season_insights"],
+    "Customer Behavior": ["payment_method_comparison", "discount_promo_impact", "subscription_discount_correlation"],
+    "Hypothesis Testing": ["hypothesis_test_results", "hypothesis_visualization"],
+}
+CATEGORIES = ["All", "Accessories", "Clothing", "Footwear", "Outerwear"]
+SEASONS = ["All", "Spring", "Summer", "Fall", "Winter"]
+PAYMENT_METHODS = ["Credit Card", "Debit Card", "PayPal", "Venmo"]
+INITIAL_INPUTS = {
+    "age_range": [35, 60],
+    "category": "All",
+    "season": "All",
+    "gender": [],
+    "payment_method": [],
+    "show_discounts": False,
+    "tab": "Overview",
+}
+
+
+class Client:
+    """The inputs a browser showing the core app would hold, and the messages it sends on change."""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.inputs = dict(INITIAL_INPUTS)
+
+    def visibility(self):
+        shown = set(TABS[self.inputs["tab"]])
+        if not self.inputs["show_discounts"]:
+            # Inside a conditional panel
+            shown.discard("discount_promo_impact")
+        return {f".clientdata_output_{name}_hidden": name not in shown for names in TABS.values() for name in names}
+
+    def init(self):
+        return {**self.inputs, **self.visibility()}
+
+    def change(self, **inputs):
+        self.inputs.update(inputs)
+        return [dict(inputs, **self.visibility())]
+
+    # Actions: each returns the updates sent for it, one per drag_interval
+    def drag_age(self):
+        low, high = self.inputs["age_range"]
+        target_low = self.rng.randint(18, 60)
+        target_high = self.rng.randint(target_low + 5, 80)
+        steps = self.rng.randint(3, 8)
+        updates = []
+        for i in range(1, steps + 1):
+            value = [round(low + (target_low - low) * i / steps), round(high + (target_high - high) * i / steps)]
+            updates += self.change(age_range=value)
+        return updates
+
+    def switch_tab(self):
+        return self.change(tab=self.rng.choice([tab for tab in TABS if tab != self.inputs["tab"]]))
+
+    def pick_category(self):
+        return self.change(category=self.rng.choice(CATEGORIES))
+
+    def pick_season(self):
+        return self.change(season=self.rng.choice(SEASONS))
+
+    def toggle_gender(self):
+        return self.change(gender=self._toggled("gender", ["Male", "Female"]))
+
+    def toggle_payment_method(self):
+        return self.change(payment_method=self._toggled("payment_method", PAYMENT_METHODS))
+
+    def toggle_discounts(self):
+        return self.change(show_discounts=not self.inputs["show_discounts"])
+
+    def _toggled(self, input_id, choices):
+        box = self.rng.choice(choices)
+        selected = self.inputs[input_id]
+        return [c for c in choices if (c in selected) != (c == box)]
+
+
+# User scripts: how often each kind of user takes each action
+SCRIPTS = {
+    "explorer": {"drag_age": 3, "switch_tab": 2, "pick_category": 2, "pick_season": 1, "toggle_gender": 1, "toggle_payment_method": 1, "toggle_discounts": 1},
+    "slider_dragger": {"drag_age": 6, "toggle_gender": 2, "pick_category": 1},
+    "tab_hopper": {"switch_tab": 5, "toggle_discounts": 1, "pick_season": 1},
+}
+
+
+def percentiles(ms):
+    if not ms:
+        return {"p50_ms": None, "p90_ms": None, "p99_ms": None, "max_ms": None}
+    ms = np.asarray(ms)
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 1),
+        "p90_ms": round(float(np.percentile(ms, 90)), 1),
+        "p99_ms": round(float(np.percentile(ms, 99)), 1),
+        "max_ms": round(float(ms.max()), 1),
+    }
+
+
+class Session:
+    """One websocket session, keeping track of when its outputs last changed."""
+
+    def __init__(self, url):
+        self.url = url
+        self.last_output = None
+        self.last_message = time.perf_counter()
+        self.busy = False
+        self.pending = set()
+        self.errors = 0
+        self.sent = time.perf_counter()
+
+    async def open(self):
+        self.ws = await websockets.connect(self.url, max_size=None)
+        await self.ws.recv()  # the session's config
+        self.reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        async for raw in self.ws:
+            now = time.perf_counter()
+            self.last_message = now
+            message = json.loads(raw)
+            if "busy" in message:
+                self.busy = message["busy"] == "busy"
+            recalculating = message.get("recalculating")
+            if recalculating:
+                # An output left without "recalculated" is waiting on the worker pool
+                if recalculating["status"] == "recalculating":
+                    self.pending.add(recalculating["name"])
+                else:
+                    self.pending.discard(recalculating["name"])
+            if message.get("values") or message.get("errors") or any(t.startswith("shinywidgets_comm") for t in message.get("custom", {})):
+                self.last_output = now
+                self.errors += len(message.get("errors") or {})
+
+    async def send(self, method, data):
+        self.last_output = None
+        self.sent = time.perf_counter()
+        await self.ws.send(json.dumps({"method": method, "data": data}))
+        return self.sent
+
+    async def settled(self, quiet, timeout):
+        """Wait until the server is idle, nothing is pending and it's been quiet for `quiet` seconds.
+
+        Returns the time of the last output message since the last send (None if there was none).
+        """
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            if not self.busy and not self.pending and time.perf_counter() - max(self.last_message, self.sent) >= quiet:
+                return self.last_output
+            await asyncio.sleep(quiet / 5)
+        raise TimeoutError(f"outputs didn't settle within {timeout} s")
+
+    async def close(self):
+        await self.ws.close()
+        self.reader.cancel()
+
+
+async def user(url, script, rng, start_at, stop_at, args, results):
+    """Replay `script` in a new session until `stop_at`; update latencies (ms) go in `results`."""
+    client = Client(rng)
+    actions, weights = zip(*SCRIPTS[script].items())
+    session = Session(url)
+    await session.open()
+    sent = await session.send("init", client.init())
+    last = await session.settled(args.quiet, args.timeout)
+    results["first_render_ms"].append(((last or time.perf_counter()) - sent) * 1000)
+    # Everyone starts once all sessions have rendered
+    await asyncio.sleep(max(0, start_at - time.perf_counter()))
+    try:
+        while time.perf_counter() < stop_at:
+            await asyncio.sleep(rng.expovariate(1 / args.think))
+            action = rng.choices(actions, weights)[0]
+            updates = getattr(client, action)()
+            for i, update in enumerate(updates):
+                if i:
+                    await asyncio.sleep(args.drag_interval)
+                sent = await session.send("update", update)
+            try:
+                last = await session.settled(args.quiet, args.timeout)
+            except TimeoutError:
+                results["timeouts"] += 1
+                continue
+            if last is not None and time.perf_counter() < stop_at:
+                results["latency_ms"].append((last - sent) * 1000)
+                results["actions"][action].append((last - sent) * 1000)
+    finally:
+        results["errors"] += session.errors
+        await session.close()
+
+
+def process_usage(pid):
+    """CPU seconds used and resident memory (MB) of process `pid`; None where /proc isn't available."""
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_text()
+        status = Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return None, None
+    # Fields after the command name, which may contain spaces
+    fields = stat[stat.rindex(")") + 2 :].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    rss = next(int(line.split()[1]) for line in status.splitlines() if line.startswith("VmRSS:")) / 1024
+    return cpu, rss
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_server(app, port, log=None):
+    # Sessions closing mid-update make the server print tracebacks; they go
+    # to `log` (an open file) if given
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--port", str(port), "--log-level", "warning"],
+        cwd=app_dir,
+        stdout=log or subprocess.DEVNULL,
+        stderr=log or subprocess.DEVNULL,
+    )
+    # Loading the dataset and warming up can take a while
+    for _ in range(600):
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with {server.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return server
+        except OSError:
+            await asyncio.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("server didn't start")
+
+
+async def run_level(n_sessions, args):
+    """Load-test a fresh server with `n_sessions` sessions; returns the level's results."""
+    port = free_port()
+    log = open(args.server_log, "a") if args.server_log else None
+    server = await start_server(args.app, port, log)
+    try:
+        url = f"ws://127.0.0.1:{port}/websocket/"
+        _, rss_idle = process_usage(server.pid)
+        results = {"latency_ms": [], "first_render_ms": [], "actions": {a: [] for s in SCRIPTS.values() for a in s}, "timeouts": 0, "errors": 0}
+        rng = random.Random(args.seed)
+        scripts = list(args.scripts or SCRIPTS)
+        # Sessions open over the ramp-up, then everyone starts together
+        start_at = time.perf_counter() + args.ramp_up
+        stop_at = start_at + args.duration
+        users = []
+        for i in range(n_sessions):
+            users.append(asyncio.create_task(user(url, scripts[i % len(scripts)], random.Random(rng.random()), start_at, stop_at, args, results)))
+            await asyncio.sleep(args.ramp_up / n_sessions / 2)
+        await asyncio.sleep(max(0, start_at - time.perf_counter()))
+        cpu_start, rss_loaded = process_usage(server.pid)
+        measured = time.perf_counter()
+        await asyncio.gather(*users)
+        elapsed = time.perf_counter() - measured
+        cpu_end, rss_end = process_usage(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+        if log:
+            log.close()
+
+    updates = len(results["latency_ms"])
+    cpu = cpu_end - cpu_start if cpu_start is not None else None
+    return {
+        "sessions": n_sessions,
+        "updates": updates,
+        "timeouts": results["timeouts"],
+        "errors": results["errors"],
+        "throughput_per_s": round(updates / elapsed, 2),
+        **percentiles(results["latency_ms"]),
+        "first_render": percentiles(results["first_render_ms"]),
+        "actions": {a: percentiles(ms) for a, ms in results["actions"].items() if ms},
+        # Cores busy, and CPU time per update and per session
+        "cpu_cores": round(cpu / elapsed, 2) if cpu is not None else None,
+        "cpu_ms_per_update": round(cpu / updates * 1000, 1) if cpu is not None and updates else None,
+        "rss_idle_mb": round(rss_idle, 1) if rss_idle is not None else None,
+        "rss_end_mb": round(rss_end, 1) if rss_end is not None else None,
+        "mb_per_session": round((rss_loaded - rss_idle) / n_sessions, 2) if rss_idle is not None else None,
+    }
+
+
+def knee(levels, gain=0.1):
+    """Largest level after which adding sessions raises throughput by less than `gain` (None if it never flattens)."""
+    for previous, level in zip(levels, levels[1:]):
+        if level["throughput_per_s"] < previous["throughput_per_s"] * (1 + gain):
+            return previous
+    return None
+
+
+def report(levels):
+    header = f"{'sessions':>8} {'updates/s':>10} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'cores':>6} {'cpu ms/upd':>10} {'MB/session':>10} {'timeouts':>8}"
+    print(header, file=sys.stderr)
+    for level in levels:
+        cells = [level["sessions"], level["throughput_per_s"], level["p50_ms"], level["p90_ms"], level["p99_ms"], level["max_ms"],
+                 level["cpu_cores"], level["cpu_ms_per_update"], level["mb_per_session"], level["timeouts"]]
+        widths = [8, 10, 9, 9, 9, 9, 6, 10, 10, 8]
+        print(" ".join(f"{'-' if c is None else c:>{w}}" for c, w in zip(cells, widths)), file=sys.stderr)
+    top = knee(levels)
+    if top is None:
+        print("Throughput still grows at the most sessions tried; try more with --sessions.", file=sys.stderr)
+    else:
+        print(
+            f"Throughput stops growing past {top['sessions']} sessions ({top['throughput_per_s']} updates/s, "
+            f"p99 {top['p99_ms']} ms); at {levels[-1]['sessions']} sessions p99 is {levels[-1]['p99_ms']} ms.",
+            file=sys.stderr,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the core app with concurrent sessions.")
+    parser.add_argument("--app", default="app_Jorge_Merged_version:app", help="ASGI app to serve, as for uvicorn")
+    parser.add_argument("--sessions", nargs="+", type=int, default=[1, 2, 4, 8, 16, 32, 64], help="session counts to try, one server each")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of replay per session count")
+    parser.add_argument("--ramp-up", type=float, default=10, help="seconds to open the sessions in")
+    parser.add_argument("--think", type=float, default=1.0, help="mean seconds between a user's actions")
+    parser.add_argument("--drag-interval", type=float, default=0.05, help="seconds between the values of a slider drag")
+    parser.add_argument("--scripts", nargs="+", choices=list(SCRIPTS), help="user scripts to replay (all by default)")
+    # Longer than the app's debounce of the age slider (see ratelimit.py)
+    parser.add_argument("--quiet", type=float, default=0.5, help="seconds without messages after which an update is complete")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds an update may take")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--server-log", help="file to append the servers' output to")
+    parser.add_argument("--output", default="loadtest.json")
+    args = parser.parse_args()
+
+    levels = []
+    for n in sorted(args.sessions):
+        print(f"{n} sessions", file=sys.stderr)
+        levels.append(asyncio.run(run_level(n, args)))
+    report(levels)
+    result = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": subprocess.run(["git", "rev-parse", "HEAD"], cwd=app_dir, capture_output=True, text=True).stdout.strip() or None,
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "app": args.app,
+            **{k: v for k, v in vars(args).items() if k not in ("app", "sessions", "output", "server_log")},
+            "env": {k: v for k, v in os.environ.items() if k.startswith("SHINY_")},
+        },
+        "levels": levels,
+        "knee_sessions": (knee(levels) or {}).get("sessions"),
+    }
+    Path(args.output).write_text(json.dumps(result, indent=1))
+    print(f"Wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+import schema
+from query import Selection
+
+# Scatter plots with more rows than this switch to a binned or sampled view, so
+# the figure sent to the browser stays bounded however much data matches
+SCATTER_MAX_POINTS = int(os.environ.get("SHINY_SCATTER_MAX_POINTS", "5000"))
+# Bins per axis of the density view
+SCATTER_BINS = int(os.environ.get("SHINY_SCATTER_BINS", "60"))
+# Points every colour group keeps in the sampled view, however small it is
+MIN_GROUP_POINTS = 20
+
+
+def stratified_sample(df, color, n, seed=0):
+    """About `n` rows of `df`, sampled separately within each `color` group.
+
+    Groups keep their share of the rows but never drop below MIN_GROUP_POINTS
+    (or their size), so small groups stay visible. Rows are kept independently
+    with their group's rate, which is linear in the rows and close enough to
+    `n` for plotting. The sample is deterministic for a given frame, so
+    redrawing the same selection doesn't flicker.
+    """
+    if len(df) <= n:
+        return df
+    rng = np.random.default_rng(seed)
+    if color is None:
+        return df.iloc[np.sort(rng.choice(len(df), size=n, replace=False))]
+
+    codes, _ = pd.factorize(df[color])
+    sizes = np.bincount(codes)
+    keep = rng.random(len(df)) < group_rates(sizes, n)[codes]
+    return df[keep]
+
+
+def group_rates(sizes, n):
+    """Share of each group's rows to keep for about `n` rows in all; see `stratified_sample`."""
+    quota = np.minimum(sizes, np.maximum(MIN_GROUP_POINTS, sizes * n / sizes.sum()))
+    return quota / sizes
+
+
+def density_heatmap(df, x, y, bins=SCATTER_BINS, title=None):
+    """Heatmap of row counts over a `bins` x `bins` grid, binned on the server.
+
+    `df` may be a `query.Selection`, whose rows are binned in the database.
+    """
+    if isinstance(df, Selection):
+        counts, x_edges, y_edges = df.histogram2d(x, y, bins)
+    else:
+        counts, x_edges, y_edges = np.histogram2d(df[x].to_numpy(), df[y].to_numpy(), bins=bins)
+    fig = go.Figure(
+        go.Heatmap(
+            x=(x_edges[:-1] + x_edges[1:]) / 2,
+            y=(y_edges[:-1] + y_edges[1:]) / 2,
+            # histogram2d counts are indexed [x, y]
+            z=counts.T,
+            colorscale=[[0, "white"], [1, "blue"]],
+            colorbar=dict(title="Rows"),
+        )
+    )
+    fig.update_layout(title=title, xaxis_title=x, yaxis_title=y)
+    return fig
+
+
+def lod_scatter(df, x, y, color=None, title=None, max_points=SCATTER_MAX_POINTS, **kwargs):
+    """`px.scatter` that degrades gracefully for large selections.
+
+    Up to `max_points` rows this is a plain scatter. Above it, a plot without
+    `color` becomes a density heatmap, and a coloured plot shows a stratified
+    sample that keeps every colour group. Either way the title reports the
+    true number of rows. Extra keyword arguments go to `px.scatter`; for
+    trendlines over all the rows see trendline.py.
+
+    Pass label codes as they are: only the rows that get plotted are decoded.
+    `df` may also be a `query.Selection`; then only the rows plotted, or the
+    bin counts, are fetched from the database.
+    """
+    n_rows = len(df)
+    if n_rows <= max_points:
+        rows = df.rows() if isinstance(df, Selection) else df
+        return px.scatter(schema.decode_frame(rows), x=x, y=y, color=color, title=title, **kwargs)
+
+    label = f"{title} " if title else ""
+    if color is None:
+        return density_heatmap(df, x, y, title=f"{label}({n_rows:,} rows, binned)")
+
+    if isinstance(df, Selection):
+        sizes = df.group_counts(color)
+        sample = df.sample(dict(zip(sizes.index, group_rates(sizes.to_numpy(), max_points))), color)
+    else:
+        sample = stratified_sample(df, color, max_points)
+    sample = schema.decode_frame(sample)
+    title = f"{label}({len(sample):,} of {n_rows:,} rows shown)"
+    return px.scatter(sample, x=x, y=y, color=color, title=title, **kwargs)
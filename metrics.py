@@ -0,0 +1,296 @@
+import bisect
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Mount, Route
+
+import workers
+from result_cache import result_cache
+
+# The instrumentation hooks into shiny internals (checked against shiny 1.8);
+# with a shiny that lays them out differently, metrics stay off
+try:
+    from shiny.reactive._core import get_current_context
+    from shiny.reactive._reactives import Calc_, Effect_
+    from shiny.render.renderer import Renderer
+    from shiny.session import get_current_session
+    from shiny.session._session import AppSession
+except ImportError:
+    Calc_ = Effect_ = Renderer = AppSession = None
+
+# Set SHINY_METRICS=1 to time every reactive calc, effect and output of the
+# dashboards and serve the numbers in Prometheus' text format on /metrics,
+# next to the app:
+#
+#   shiny_invalidations_total          how often each calc, effect and output was invalidated
+#   shiny_compute_seconds              how long each of them took to run
+#   shiny_output_serialize_seconds     time spent turning an output's value into JSON
+#   shiny_output_payload_bytes         size of that JSON
+#   shiny_widget_message_bytes         size of the messages a plotly widget sends after it
+#
+# plus the result cache's and worker pool's counters. Outputs are labelled by
+# their id and calcs and effects by their function's name, so the numbers add
+# up across sessions. Set SHINY_SLOW_RENDER_MS to also log every output that
+# takes longer than that to compute and serialize.
+METRICS = os.environ.get("SHINY_METRICS", "0") == "1"
+SLOW_RENDER_MS = float(os.environ.get("SHINY_SLOW_RENDER_MS", "0"))
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+log = logging.getLogger(__name__)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Counter:
+    """Prometheus counter with one value per combination of labels."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram(Counter):
+    """Prometheus histogram with one set of buckets per combination of labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # Per bucket (the last for +Inf), then the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+        names = self.labels + ("le",)
+        for labels, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(names, labels + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {counts[-1]}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+invalidations = Counter("shiny_invalidations_total", "Invalidations of reactive calcs, effects and outputs.", ["kind", "name"])
+compute_seconds = Histogram("shiny_compute_seconds", "Time reactive calcs, effects and outputs took to run.", ["kind", "name"])
+serialize_seconds = Histogram("shiny_output_serialize_seconds", "Time spent serializing an output's value to JSON.", ["output"])
+payload_bytes = Histogram("shiny_output_payload_bytes", "Size of an output's value as JSON.", ["output"], BYTES_BUCKETS)
+widget_bytes = Histogram("shiny_widget_message_bytes", "Size of the messages sent to an output's widget.", ["output"], BYTES_BUCKETS)
+REGISTRY = [invalidations, compute_seconds, serialize_seconds, payload_bytes, widget_bytes]
+
+# Per session, the output each widget model (a plotly FigureWidget) was
+# rendered to; dropped when the session ends
+_widget_outputs = {}
+_instrumented = False
+
+
+def _widget_rendered(model_id, output_id):
+    session = get_current_session()
+    if session is None:
+        return
+    session = session.root_scope()
+    outputs = _widget_outputs.get(session.id)
+    if outputs is None:
+        outputs = _widget_outputs[session.id] = {}
+        session.on_ended(lambda: _widget_outputs.pop(session.id, None))
+    # An output's earlier widgets are closed when it renders a new one
+    for model in [model for model, output in outputs.items() if output == output_id]:
+        del outputs[model]
+    outputs[model_id] = output_id
+
+
+def _timed_render(renderer, output_id):
+    render = renderer.render
+
+    async def timed():
+        # Invalidating this context is the output going out of date
+        get_current_context().on_invalidate(lambda: invalidations.inc("output", output_id))
+        start = time.perf_counter()
+        value = await render()
+        computed = time.perf_counter() - start
+        # Shiny serializes the value again when it sends it; the cost of this
+        # copy is only paid with SHINY_METRICS on
+        start = time.perf_counter()
+        size = len(json.dumps(value).encode())
+        serialized = time.perf_counter() - start
+        compute_seconds.observe(computed, "output", output_id)
+        serialize_seconds.observe(serialized, output_id)
+        payload_bytes.observe(size, output_id)
+        if isinstance(value, dict) and "model_id" in value:
+            _widget_rendered(value["model_id"], output_id)
+        if SLOW_RENDER_MS and (computed + serialized) * 1000 > SLOW_RENDER_MS:
+            log.warning(
+                "Output %s took %.0f ms to compute and %.0f ms to serialize (%d bytes)",
+                output_id, computed * 1000, serialized * 1000, size,
+            )
+        return value
+
+    return timed
+
+
+def _missing_hooks():
+    # The shiny internals instrument() replaces that this shiny doesn't have
+    if Calc_ is None:
+        return ["shiny.reactive._reactives", "shiny.render.renderer", "shiny.session._session"]
+    hooks = {
+        Calc_: ["_run_func", "_on_invalidate_cb"],
+        Effect_: ["_run", "_create_context"],
+        Renderer: ["_set_output_metadata"],
+        AppSession: ["send_custom_message"],
+    }
+    missing = [f"{cls.__name__}.{name}" for cls, names in hooks.items() for name in names if not hasattr(cls, name)]
+    if hasattr(Renderer, "_set_output_metadata") and "output_id" not in inspect.signature(Renderer._set_output_metadata).parameters:
+        missing.append("Renderer._set_output_metadata(output_id=)")
+    return missing
+
+
+def instrument():
+    """Start recording calcs, effects and outputs in this process; once is enough.
+
+    Returns whether they're recorded: False, with a warning, when this shiny
+    doesn't have the internals the recording hooks into.
+    """
+    global _instrumented
+    if _instrumented:
+        return True
+    missing = _missing_hooks()
+    if missing:
+        log.warning("Metrics are off: this shiny has no %s", ", ".join(missing))
+        return False
+    _instrumented = True
+
+    calc_run, calc_invalidated = Calc_._run_func, Calc_._on_invalidate_cb
+    effect_run, effect_context = Effect_._run, Effect_._create_context
+    set_output_metadata = Renderer._set_output_metadata
+    send_custom_message = AppSession.send_custom_message
+
+    async def _run_func(self):
+        start = time.perf_counter()
+        try:
+            await calc_run(self)
+        finally:
+            compute_seconds.observe(time.perf_counter() - start, "calc", self.__name__)
+
+    def _on_invalidate_cb(self):
+        invalidations.inc("calc", self.__name__)
+        calc_invalidated(self)
+
+    # Every output runs in an effect named output_obs; those are recorded
+    # per output by _timed_render() instead
+    async def _run(self):
+        if self.__name__ == "output_obs":
+            return await effect_run(self)
+        start = time.perf_counter()
+        try:
+            await effect_run(self)
+        finally:
+            compute_seconds.observe(time.perf_counter() - start, "effect", self.__name__)
+
+    def _create_context(self):
+        ctx = effect_context(self)
+        if self.__name__ != "output_obs":
+            ctx.on_invalidate(lambda: invalidations.inc("effect", self.__name__))
+        return ctx
+
+    def _set_output_metadata(self, *, output_id):
+        set_output_metadata(self, output_id=output_id)
+        # Outputs set their render() in subclasses, so it's wrapped per
+        # instance when the session registers it
+        if "render" not in vars(self):
+            self.render = _timed_render(self, output_id)
+
+    async def _send_custom_message(self, type, message):
+        # shinywidgets sends widget updates as JSON text ending in the
+        # model's "ident"; they count towards the output it was rendered to
+        if type.startswith("shinywidgets_comm") and isinstance(message, str):
+            start = message.rfind('"ident": "comm-')
+            if start >= 0:
+                model_id = message[start + 15 : message.index('"', start + 15)]
+                output_id = _widget_outputs.get(self.id, {}).get(model_id)
+                if output_id is not None:
+                    widget_bytes.observe(len(message.encode()), output_id)
+        await send_custom_message(self, type, message)
+
+    Calc_._run_func = _run_func
+    Calc_._on_invalidate_cb = _on_invalidate_cb
+    Effect_._run = _run
+    Effect_._create_context = _create_context
+    Renderer._set_output_metadata = _set_output_metadata
+    AppSession.send_custom_message = _send_custom_message
+    return True
+
+
+def exposition():
+    """All metrics in Prometheus' text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}", *metric.samples()]
+    for name, value in result_cache.stats().items():
+        kind = "counter" if name in ("hits", "misses", "evictions") else "gauge"
+        metric = f"shiny_result_cache_{name}" + ("_total" if kind == "counter" else "")
+        lines += [f"# TYPE {metric} {kind}", f"{metric} {value}"]
+    lines.append("# TYPE shiny_worker_jobs gauge")
+    lines += [f'shiny_worker_jobs{{state="{state}"}} {count}' for state, count in workers.stats().items()]
+    return "\n".join(lines) + "\n"
+
+
+async def metrics_endpoint(request):
+    return PlainTextResponse(exposition(), media_type="text/plain; version=0.0.4")
+
+
+def with_metrics(app):
+    """`app` with a /metrics route next to it when SHINY_METRICS is on, else `app` itself."""
+    if not METRICS or not instrument():
+        return app
+    return Starlette(routes=[Route("/metrics", metrics_endpoint), Mount("/", app=app)])
+
+
+def __getattr__(name):
+    # The express app (app.py) has no App object of its own to wrap; serve
+    # this one instead to get /metrics with it:
+    #   SHINY_METRICS=1 uvicorn metrics:express_app
+    if name == "express_app":
+        from shiny.express import wrap_express_app
+
+        global express_app
+        express_app = with_metrics(wrap_express_app(Path(__file__).parent / "app.py"))
+        return express_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,148 @@
+import os
+import re
+import threading
+import weakref
+
+import numpy as np
+
+import schema
+from shared import derived_arrays
+
+# Rows per page of the data table
+PAGE_SIZE = int(os.environ.get("SHINY_TABLE_PAGE_SIZE", "100"))
+# Built pages each pager keeps around
+PAGES_KEPT = 4
+
+_sort_orders = {}
+_sort_orders_lock = threading.Lock()
+
+
+def sort_order(df, column):
+    """Row positions of `df` in ascending `column` order.
+
+    Computed once per process for each column of a long-lived frame such as
+    `shared.shopping_trends` (and shared between workers when it's
+    memory-mapped), and dropped with the frame, e.g. once streamed rows have
+    replaced it. Label codes are alphabetical, so codes sort like labels.
+    """
+    key = (id(df), column)
+    with _sort_orders_lock:
+        if key not in _sort_orders:
+            build = lambda: {"order": np.argsort(df[column].to_numpy(), kind="stable")}
+            _sort_orders[key] = derived_arrays(df, f"sort-{column}", build)["order"]
+            weakref.finalize(df, _sort_orders.pop, key, None)
+        return _sort_orders[key]
+
+
+def column_filter(column, text):
+    """The filter `text` on `column` as (ranges, values), or None for no filter.
+
+    Label columns match labels containing `text` (case-insensitively). Numeric
+    columns take a value or an inclusive range such as `20-40` or `20..40`; anything else
+    matches nothing. The result is in the form `shared.FilterIndex.mask` and
+    `query.Selection.narrowed` take.
+    """
+    text = (text or "").strip()
+    if not column or not text:
+        return None
+    if column in schema.LABELS:
+        codes = [code for code, label in enumerate(schema.LABELS[column]) if text.lower() in label.lower()]
+        return {}, {column: codes}
+    bounds = re.fullmatch(r"\s*(-?\d+(?:\.\d+)?)\s*(?:(?:-|\.\.)\s*(-?\d+(?:\.\d+)?))?\s*", text)
+    try:
+        lo = float(bounds.group(1))
+        hi = float(bounds.group(2)) if bounds.group(2) else lo
+    except (AttributeError, ValueError):
+        return {}, {column: []}
+    return {column: (lo, hi)}, {}
+
+
+def column_filter_mask(df, column, text):
+    """Rows of `df` whose `column` matches the filter `text`, or None for no filter.
+
+    See `column_filter`.
+    """
+    spec = column_filter(column, text)
+    if spec is None:
+        return None
+    ranges, values = spec
+    column_values = df[column].to_numpy()
+    if column in values:
+        return np.isin(column_values, values[column])
+    lo, hi = ranges[column]
+    return (column_values >= lo) & (column_values <= hi)
+
+
+def ordered_rows(df, mask, sort=None, descending=False):
+    """Positions of the rows selected by `mask`, in `sort` column order."""
+    if not sort:
+        positions = np.flatnonzero(mask)
+    else:
+        order = sort_order(df, sort)
+        positions = order[mask[order]]
+    return positions[::-1] if descending else positions
+
+
+class Pager:
+    """Pages of the `df` rows at `positions`, built only when asked for.
+
+    Only the rows of a page are taken and decoded, so the table costs the same
+    however many rows match. `prefetch()` builds a page ahead of time; it's
+safe to call from a worker thread.
+    """
+
+    def __init__(self, df, positions, page_size=PAGE_SIZE):
+        self.df = df
+        self.positions = positions
+        self.page_size = page_size
+        self.n_rows = len(positions)
+        self.n_pages = max(1, -(-self.n_rows // page_size))
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def clamp(self, number):
+        return min(max(int(number or 1), 1), self.n_pages)
+
+    def bounds(self, number):
+        """(first, last) row numbers of page `number`, counting from 1."""
+        start = (self.clamp(number) - 1) * self.page_size
+        return start + 1 if self.n_rows else 0, min(start + self.page_size, self.n_rows)
+
+    def page(self, number):
+        number = self.clamp(number)
+        with self._lock:
+            page = self._pages.get(number)
+        if page is None:
+            # Built outside the lock, so showing a page never waits for a
+            # prefetch of another one on a worker thread
+            start = (number - 1) * self.page_size
+            page = schema.decode_frame(self._rows(start, start + self.page_size))
+            with self._lock:
+                self._pages[number] = page
+                # Keep the few most recent pages, e.g. the current one and the next
+                while len(self._pages) > PAGES_KEPT:
+                    del self._pages[next(iter(self._pages))]
+        return page
+
+    def prefetch(self, number):
+        if 1 <= number <= self.n_pages:
+            self.page(number)
+
+    def _rows(self, start, stop):
+        return self.df.iloc[self.positions[start:stop]]
+
+
+class QueryPager(Pager):
+    """Pages of a `query.Selection` in `sort` column order, each fetched with one query.
+
+    Works like `Pager`, with the sorting and paging done by the database.
+    """
+
+    def __init__(self, selection, sort=None, descending=False, page_size=PAGE_SIZE):
+        super().__init__(None, range(selection.count()), page_size)
+        self.selection = selection
+        self.sort = sort
+        self.descending = descending
+
+    def _rows(self, start, stop):
+        return self.selection.page(start, stop - start, self.sort, self.descending)
@@ -0,0 +1,78 @@
+import os
+
+import plotly.graph_objects as go
+from shiny import reactive
+from shiny.session import get_current_session, session_context
+
+from transport import figure_diff, typed_arrays
+
+# Keep one FigureWidget per plot output and patch it in place, instead of
+# sending a whole new figure on every change. Set SHINY_PERSISTENT_WIDGETS=0
+# to render a fresh figure each time.
+PERSISTENT_WIDGETS = os.environ.get("SHINY_PERSISTENT_WIDGETS", "1") != "0"
+
+
+class PersistentFigure:
+    """A FigureWidget for output `output_id` that follows `figure()` in place.
+
+    The first figure becomes the widget the output renders. After that, the
+    output isn't rendered again: each new figure is compared with the one
+    showing (see `transport.figure_diff()`) and only the trace properties
+    and layout fields that changed are sent, in one batch update, so a
+    filter change moves data over the wire and keeps the chart's zoom and
+    legend state in the browser. A figure with different traces replaces
+    the widget.
+
+    `figure()` is read only while the output is showing, so plots on hidden
+    tabs still cost nothing until they're opened.
+    """
+
+    def __init__(self, output_id, figure, session=None):
+        self._figure = figure
+        self._session = session if session is not None else get_current_session()
+        self._widget = None
+        self._shown = None
+        # Bumped when the output has to render a new widget
+        self._version = reactive.value(0)
+
+        @reactive.effect
+        def _follow():
+            if self._session.clientdata.output_hidden(output_id) is not False:
+                return
+            self._show(self._figure())
+
+        self._session.on_ended(self.close)
+
+    def widget(self):
+        """The widget for the output's render function to return."""
+        self._version()
+        return self._widget
+
+    def _show(self, fig):
+        shown = None if fig is None else fig.to_dict()
+        if self._widget is not None and shown is not None:
+            diff = figure_diff(self._shown, shown)
+            if diff is not None:
+                self._patch(diff)
+                self._shown = shown
+                return
+        self.close()
+        self._widget = None if fig is None else go.FigureWidget(fig)
+        self._shown = shown
+        with reactive.isolate():
+            self._version.set(self._version() + 1)
+
+    def _patch(self, diff):
+        if not diff["data"] and not diff["layout"]:
+            return
+        with self._widget.batch_update():
+            for i, changes in diff["data"].items():
+                self._widget.data[i].update(typed_arrays(changes), overwrite=True)
+            if diff["layout"]:
+                self._widget.layout.update(typed_arrays(diff["layout"]), overwrite=True)
+
+    def close(self):
+        if self._widget is not None:
+            with session_context(self._session):
+                self._widget.close()
+            self._widget = None
@@ -0,0 +1,405 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import schema
+
+try:
+    import duckdb
+except ImportError:  # DuckDB is optional; SQLite databases need only the standard library
+    duckdb = None
+
+# Set SHINY_QUERY_SOURCE to an SQLite database (table SHINY_QUERY_TABLE) or a
+# Parquet file, as written by `python query.py build`, to leave the rows there:
+# filters and aggregations run in the database and only their results, a page
+# of the table or a plot's sample come back. Nothing is loaded into memory,
+# so the table can have tens of millions of rows. DuckDB (optional) scans
+# Parquet much faster than SQLite; SQLite's indexes help narrow filters.
+QUERY_SOURCE = os.environ.get("SHINY_QUERY_SOURCE")
+QUERY_TABLE = os.environ.get("SHINY_QUERY_TABLE", "shopping_trends")
+
+# Columns built SQLite databases get an index on: those the sidebars filter on
+INDEXED_COLUMNS = ["Age", "Purchase_Amount_USD", "Gender", "Category", "Season", "Payment_Method"]
+
+
+def name(column):
+    """`column` quoted as an SQL identifier."""
+    return '"' + column.replace('"', '""') + '"'
+
+
+def ratio(numerator, denominator):
+    """SQL expression for `numerator / denominator` of two columns, as a float."""
+    return f"CAST({name(numerator)} AS DOUBLE) / {name(denominator)}"
+
+
+def _param(value):
+    # Query parameters as plain Python values; sqlite3 can't bind NumPy scalars
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def where_clause(filters):
+    """SQL condition and parameters for a list of (ranges, values) filters.
+
+    Each filter takes inclusive `ranges` and allowed `values` per column, as
+    `shared.FilterIndex.mask` does; rows have to pass all of them. An empty
+    list of allowed values matches nothing.
+    """
+    conditions, params = [], []
+    for ranges, values in filters:
+        for col, (lo, hi) in (ranges or {}).items():
+            conditions.append(f"{name(col)} BETWEEN ? AND ?")
+            params += [_param(lo), _param(hi)]
+        for col, allowed in (values or {}).items():
+            if len(allowed) == 0:
+                conditions.append("1 = 0")
+            else:
+                conditions.append(f"{name(col)} IN ({', '.join('?' * len(allowed))})")
+                params += [_param(v) for v in allowed]
+    return " AND ".join(conditions) or "1 = 1", params
+
+
+class QueryBackend:
+    """The shopping-trends table in an SQL engine, queried in place.
+
+    Subclasses open one connection per thread (figures are built on the
+    worker pool) and say how their engine spells a few things. `select()`
+    gives the rows some filters match, to ask questions about.
+    """
+
+    # SQL for the table, a column giving the rows' order and a number in
+    # [0, 1) that's fixed per row but spread evenly, to sample by
+    source = None
+    row_order = None
+    sample_key = None
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._local = threading.local()
+        stat = self.path.stat()
+        # Results are cached per version; a rebuilt database gets a new one
+        self.version = hashlib.sha256(f"{self.path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+        columns = self.query(f"SELECT * FROM {self.source} LIMIT 0").columns
+        self.columns = [col for col in columns if col != self.row_order]
+
+    def connect(self):
+        raise NotImplementedError
+
+    def execute(self, connection, sql, params):
+        raise NotImplementedError
+
+    def floor(self, expr):
+        """SQL for the integer part of the non-negative `expr`."""
+        raise NotImplementedError
+
+    def query(self, sql, params=()):
+        """Result of `sql` as a DataFrame, on this thread's connection."""
+        # Connections don't survive a fork (see serve.py); each process opens its own
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.connection = self.connect()
+            self._local.pid = os.getpid()
+        return self.execute(self._local.connection, sql, list(params))
+
+    def empty_frame(self):
+        """A frame with the table's columns, in the dataset's dtypes, and no rows."""
+        df = pd.DataFrame({col: pd.Series(dtype=schema.DTYPES.get(col, "float64")) for col in self.columns})
+        df.attrs["version"] = self.version
+        return df
+
+    def select(self, ranges=None, values=None):
+        return Selection(self, [(ranges, values)])
+
+
+class SqliteBackend(QueryBackend):
+    """An SQLite database, opened read-only."""
+
+    row_order = "rowid"
+    # Multiplicative hash of the rowid (Knuth's constant)
+    sample_key = "((rowid * 2654435761) % 4294967296) / 4294967296.0"
+
+    def __init__(self, path, table=QUERY_TABLE):
+        self.source = name(table)
+        super().__init__(path)
+
+    def connect(self):
+        connection = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True)
+        # Map the file instead of copying pages into each connection's cache
+        connection.execute("PRAGMA mmap_size = 1073741824")
+        return connection
+
+    def execute(self, connection, sql, params):
+        return pd.read_sql_query(sql, connection, params=params)
+
+    def floor(self, expr):
+        return f"CAST({expr} AS INTEGER)"
+
+
+class DuckdbBackend(QueryBackend):
+    """A Parquet file, queried with DuckDB."""
+
+    row_order = "file_row_number"
+    sample_key = "(hash(file_row_number) % 4294967296) / 4294967296.0"
+
+    def __init__(self, path):
+        if duckdb is None:
+            raise RuntimeError(f"Querying {path} needs DuckDB: pip install duckdb")
+        quoted = str(Path(path).resolve()).replace("'", "''")
+        self.source = f"read_parquet('{quoted}', file_row_number = true)"
+        # (pid, database), opened again in a forked process
+        self._database = None
+        super().__init__(path)
+
+    def connect(self):
+        if self._database is None or self._database[0] != os.getpid():
+            self._database = (os.getpid(), duckdb.connect())
+        return self._database[1].cursor()
+
+    def execute(self, connection, sql, params):
+        return connection.execute(sql, params).df()
+
+    def floor(self, expr):
+        return f"CAST(FLOOR({expr}) AS BIGINT)"
+
+
+def backend_of(spec, table=QUERY_TABLE):
+    """Backend for a SHINY_QUERY_SOURCE path, by its extension."""
+    suffix = Path(spec).suffix.lower()
+    if suffix in (".db", ".sqlite", ".sqlite3"):
+        return SqliteBackend(spec, table)
+    if suffix == ".parquet":
+        return DuckdbBackend(spec)
+    raise ValueError(f"Don't know how to query {spec!r}; use an SQLite or Parquet file")
+
+
+class Selection:
+    """The rows of a backend's table that pass some filters.
+
+    Nothing runs until a result is asked for, and each method is a single
+    query (two for the ones that need the data's range first) that returns
+    only what a chart or table shows. Label columns come back as codes in
+    the dataset's dtypes, as from `shared.shopping_trends`.
+    """
+
+    def __init__(self, backend, filters, columns=None):
+        self.backend = backend
+        self.filters = filters
+        self.columns = columns or backend.columns
+
+    def __getitem__(self, columns):
+        # Like a frame's column selection: the columns rows come back with
+        return Selection(self.backend, self.filters, list(columns))
+
+    def narrowed(self, ranges=None, values=None):
+        """The rows of this selection that also pass `ranges` and `values`."""
+        return Selection(self.backend, self.filters + [(ranges, values)], self.columns)
+
+    def _query(self, select, tail="", params=()):
+        where, where_params = where_clause(self.filters)
+        return self.backend.query(f"SELECT {select} FROM {self.backend.source} WHERE {where} {tail}", where_params + list(params))
+
+    def _typed(self, df):
+        return df.astype({col: schema.DTYPES[col] for col in df.columns if col in schema.DTYPES})
+
+    def _bin(self, position, bins):
+        # Bin of the non-negative SQL `position` (in bin widths) on a grid of
+        # `bins`; the far end goes in the last bin, as in np.histogram
+        return f"CASE WHEN {position} >= {bins - 1} THEN {bins - 1} ELSE {self.backend.floor(position)} END"
+
+    def __len__(self):
+        return self.count()
+
+    def count(self):
+        return int(self._query("COUNT(*) AS n")["n"].iloc[0])
+
+    def summary(self, measure):
+        """(rows, mean of `measure`); the mean is NaN if there are no rows."""
+        row = self._query(f"COUNT(*) AS n, AVG(CAST({name(measure)} AS DOUBLE)) AS mean").iloc[0]
+        return int(row["n"]), float(row["mean"]) if pd.notna(row["mean"]) else np.nan
+
+    def bounds(self, expr):
+        """(min, max) of the SQL expression `expr`, or None if there are no rows."""
+        row = self._query(f"MIN({expr}) AS lo, MAX({expr}) AS hi").iloc[0]
+        return None if pd.isna(row["lo"]) else (float(row["lo"]), float(row["hi"]))
+
+    def group_counts(self, column):
+        """Rows per value of `column`, as a Series indexed by the values present."""
+        counts = self._query(f"{name(column)} AS value, COUNT(*) AS n", f"GROUP BY {name(column)} ORDER BY {name(column)}")
+        return pd.Series(counts["n"].to_numpy(np.int64), index=counts["value"].to_numpy(), name=column)
+
+    def counts(self, columns):
+        """Rows per combination of `columns` present, as a frame of those columns and `n`."""
+        keys = ", ".join(name(col) for col in columns)
+        counts = self._query(f"{keys}, COUNT(*) AS n", f"GROUP BY {keys} ORDER BY {keys}")
+        return self._typed(counts).astype({"n": np.int64})
+
+    def means(self, measure, groupings):
+        """Mean of `measure` per group of each grouping, and overall under ().
+
+        Laid out like the rollups of the in-memory path. One query groups by
+        every column the groupings use; each grouping is rolled up from that.
+        """
+        columns = list(dict.fromkeys(col for by in groupings for col in by))
+        keys = ", ".join(name(col) for col in columns)
+        cells = self._query(
+            f"{keys}, SUM(CAST({name(measure)} AS DOUBLE)) AS total, COUNT(*) AS n",
+            f"GROUP BY {keys}",
+        )
+        means = {}
+        for by in groupings:
+            groups = cells.groupby(list(by), sort=True)[["total", "n"]].sum()
+            means[tuple(by)] = (groups["total"] / groups["n"]).rename(measure)
+        count = cells["n"].sum()
+        means[()] = cells["total"].sum() / count if count else np.nan
+        return means
+
+    def rows(self):
+        """All the selected rows; for selections known to be small."""
+        return self._typed(self._query(", ".join(name(col) for col in self.columns), f"ORDER BY {self.backend.row_order}"))
+
+    def sample(self, rates, group=None):
+        """Rows kept with probability `rates[value of group]` (or `rates` without a group).
+
+        Which rows are kept depends only on the row, so the same selection
+        always gives the same sample.
+        """
+        columns = ", ".join(name(col) for col in self.columns)
+        if group is None:
+            return self._typed(self._query(columns, f"AND {self.backend.sample_key} < ? ORDER BY {self.backend.row_order}", [float(rates)]))
+        cases = " ".join("WHEN ? THEN ?" for _ in rates)
+        params = [v for value, rate in rates.items() for v in (_param(value), float(rate))]
+        return self._typed(
+            self._query(
+                columns,
+                f"AND {self.backend.sample_key} < CASE {name(group)} {cases} ELSE 0 END ORDER BY {self.backend.row_order}",
+                params,
+            )
+        )
+
+    def histogram2d(self, x, y, bins):
+        """Row counts over a `bins` x `bins` grid, as `np.histogram2d` returns them."""
+        edges = []
+        for col in (x, y):
+            lo, hi = self.bounds(name(col))
+            if lo == hi:
+                lo, hi = lo - 0.5, hi + 0.5
+            edges.append(np.linspace(lo, hi, bins + 1))
+        x_edges, y_edges = edges
+        position = lambda col, edges: f"({name(col)} - {float(edges[0])!r}) / {float(edges[1] - edges[0])!r}"
+        cells = self._query(
+            f"{self._bin(position(x, x_edges), bins)} AS x_bin, {self._bin(position(y, y_edges), bins)} AS y_bin, COUNT(*) AS n",
+            "GROUP BY x_bin, y_bin",
+        )
+        counts = np.zeros((bins, bins))
+        counts[cells["x_bin"].to_numpy(np.intp), cells["y_bin"].to_numpy(np.intp)] = cells["n"].to_numpy()
+        return counts, x_edges, y_edges
+
+    def bin_sums(self, x, y, bins, group=None):
+        """Per-bin sums of `y` on `x` for `trendline.fit_bins`, for each `group` value.
+
+        Each group's x range is split into `bins` equal bins, as
+        `trendline.binned_lowess` does. Returns {value (None without a
+        group): (n, sx, sy, sxx, sxy)} over the bins that have points.
+        """
+        key = name(group) if group else "0"
+        ranges = self._query(f"{key} AS g, MIN({name(x)}) AS lo, MAX({name(x)}) AS hi", f"GROUP BY {key}" if group else "")
+        ranges = ranges[ranges["lo"].notna()]
+        if ranges.empty:
+            return {}
+        lo, width = [], []
+        for _, row in ranges.iterrows():
+            lo.append(float(row["lo"]))
+            width.append((float(row["hi"]) - float(row["lo"])) / bins or 1.0)
+        # Each group's grid, picked by the group's value
+        cases = lambda values: "CASE g " + " ".join(f"WHEN {_param(g)!r} THEN {v!r}" for g, v in zip(ranges["g"], values)) + " END"
+        xs, ys = f"CAST({name(x)} AS DOUBLE)", f"CAST({name(y)} AS DOUBLE)"
+        where, params = where_clause(self.filters)
+        points = f"SELECT {key} AS g, {xs} AS x, {ys} AS y FROM {self.backend.source} WHERE {where}"
+        sums = self.backend.query(
+            f"SELECT g, {self._bin(f'(x - {cases(lo)}) / {cases(width)}', bins)} AS b, "
+            "COUNT(*) AS n, SUM(x) AS sx, SUM(y) AS sy, SUM(x * x) AS sxx, SUM(x * y) AS sxy "
+            f"FROM ({points}) AS points GROUP BY g, b ORDER BY g, b",
+            params,
+        )
+        return {
+            (None if group is None else value): tuple(bins_of[col].to_numpy(np.float64) for col in ("n", "sx", "sy", "sxx", "sxy"))
+            for value, bins_of in sums.groupby("g", sort=True)
+        }
+
+    def linear_bins(self, expr, group, lo, width, bins):
+        """Linear-binned counts of `expr` per `group` code, as `density.linear_bin_counts` makes.
+
+        Returns an (n_groups, bins) array, n_groups being the largest code
+        present plus one.
+        """
+        where, params = where_clause(self.filters)
+        positions = f"SELECT {name(group)} AS g, (({expr}) - ?) / ? - 0.5 AS p FROM {self.backend.source} WHERE {where}"
+        lefts = f"SELECT g, p, CASE WHEN p < 0 THEN 0 WHEN p >= {bins - 2} THEN {bins - 2} ELSE {self.backend.floor('p')} END AS l FROM ({positions}) AS positions"
+        shares = f"SELECT g, l, CASE WHEN p - l < 0 THEN 0 WHEN p - l > 1 THEN 1 ELSE p - l END AS s FROM ({lefts}) AS lefts"
+        cells = self.backend.query(
+            f"SELECT g, l, SUM(1 - s) AS left_weight, SUM(s) AS right_weight FROM ({shares}) AS shares GROUP BY g, l",
+            [float(lo), float(width)] + params,
+        )
+        g = cells["g"].to_numpy(np.intp)
+        left = cells["l"].to_numpy(np.intp)
+        counts = np.zeros((g.max() + 1 if len(g) else 0, bins))
+        np.add.at(counts, (g, left), cells["left_weight"].to_numpy())
+        np.add.at(counts, (g, left + 1), cells["right_weight"].to_numpy())
+        return counts
+
+    def page(self, offset, limit, sort=None, descending=False):
+        """`limit` rows from `offset` on, in `sort` column order (then row order)."""
+        direction = " DESC" if descending else ""
+        order = ([f"{name(sort)}{direction}"] if sort else []) + [f"{self.backend.row_order}{direction}"]
+        columns = ", ".join(name(col) for col in self.columns)
+        return self._typed(self._query(columns, f"ORDER BY {', '.join(order)} LIMIT ? OFFSET ?", [int(limit), int(offset)]))
+
+
+query_backend = backend_of(QUERY_SOURCE) if QUERY_SOURCE else None
+
+
+def build(csv_path, target, table=QUERY_TABLE, chunk_rows=1_000_000):
+    """Write the rows of `csv_path` to an SQLite database or Parquet file `target`.
+
+    The CSV is read a chunk at a time, so it can be larger than memory.
+    Label columns may hold labels or codes; they're stored as codes. An
+    SQLite database gets an index on each of INDEXED_COLUMNS.
+    """
+    target = Path(target)
+    suffix = target.suffix.lower()
+    chunks = (schema.encode_frame(chunk) for chunk in pd.read_csv(csv_path, chunksize=chunk_rows))
+    if suffix == ".parquet":
+        if duckdb is None:
+            raise RuntimeError("Writing Parquet needs DuckDB: pip install duckdb")
+        with duckdb.connect() as db:
+            for i, chunk in enumerate(chunks):
+                db.register("chunk", chunk)
+                db.execute("CREATE TABLE dataset AS SELECT * FROM chunk" if i == 0 else "INSERT INTO dataset SELECT * FROM chunk")
+                db.unregister("chunk")
+            db.execute(f"COPY dataset TO '{str(target).replace(chr(39), chr(39) * 2)}' (FORMAT parquet)")
+        return target
+    if suffix not in (".db", ".sqlite", ".sqlite3"):
+        raise ValueError(f"Don't know how to write {target}; use an SQLite or Parquet file name")
+    with sqlite3.connect(target) as db:
+        db.execute(f"DROP TABLE IF EXISTS {name(table)}")
+        for chunk in chunks:
+            chunk.to_sql(table, db, if_exists="append", index=False)
+        for col in INDEXED_COLUMNS:
+            db.execute(f"CREATE INDEX IF NOT EXISTS {name(f'{table}_{col}')} ON {name(table)} ({name(col)})")
+        db.execute("ANALYZE")
+    db.close()
+    return target
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a query backend for the dashboards (see SHINY_QUERY_SOURCE).")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("csv", help="CSV with the dataset's columns, e.g. Data/shopping_trends_imputed.csv")
+    parser.add_argument("target", help="SQLite database (.db) or Parquet file (.parquet) to write")
+    parser.add_argument("--table", default=QUERY_TABLE, help="table name in an SQLite database")
+    args = parser.parse_args()
+    print(build(args.csv, args.target, args.table))
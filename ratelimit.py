@@ -0,0 +1,89 @@
+import os
+import time
+
+from shiny import reactive
+
+
+def interval(input_id, default):
+    """Seconds to rate-limit `input_id` by: `default`, unless overridden.
+
+    Set SHINY_RATE_LIMIT_<INPUT_ID> to a number of milliseconds to override it,
+    e.g. SHINY_RATE_LIMIT_AGE_RANGE=500; 0 turns rate limiting off for the input.
+    """
+    value = os.environ.get(f"SHINY_RATE_LIMIT_{input_id.upper()}")
+    return default if value is None else float(value) / 1000
+
+
+def _rate_limited(fn, delay, throttle):
+    source = reactive.calc(fn)
+    # The value dependents see, and when the pending one is due to replace it
+    current = reactive.value()
+    due = reactive.value(None)
+    last_change = float("-inf")
+
+    def publish(value):
+        nonlocal last_change
+        last_change = time.monotonic()
+        due.set(None)
+        # reactive.value only compares identity; don't wake dependents up
+        # for an equal value
+        if not current.is_set() or current() != value:
+            current.set(value)
+
+    # Higher priority than outputs, so the first value is there when they start
+    @reactive.effect(priority=100)
+    def _watch():
+        value = source()
+        with reactive.isolate():
+            now = time.monotonic()
+            if not current.is_set() or delay <= 0:
+                publish(value)
+            elif value == current():
+                # Moved back to what's showing: nothing to do
+                due.set(None)
+            elif throttle and last_change + delay <= now:
+                publish(value)
+            elif throttle:
+                due.set(last_change + delay)
+            else:
+                due.set(now + delay)
+
+    @reactive.effect(priority=99)
+    def _timer():
+        when = due()
+        if when is None:
+            return
+        remaining = when - time.monotonic()
+        if remaining > 0:
+            reactive.invalidate_later(remaining)
+            return
+        with reactive.isolate():
+            # The latest value; ones that came and went in between are skipped
+            publish(source())
+
+    @reactive.calc
+    def limited():
+        return current()
+
+    return limited
+
+
+def debounce(delay):
+    """Reactive calc of the decorated function that waits for it to settle.
+
+    A new value is passed on once the function has kept it for `delay` seconds,
+    so dragging a slider re-runs dependents once, for where it stops, instead
+    of once per intermediate value. The first value passes straight through.
+    Create it in a session (inside `server()`, or at the top level of an
+    express app).
+    """
+    return lambda fn: _rate_limited(fn, delay, throttle=False)
+
+
+def throttle(delay):
+    """Reactive calc of the decorated function that changes at most every `delay` seconds.
+
+    Unlike `debounce()`, dependents follow along while the value keeps
+    changing, with only the latest value of each interval passed on.
+    """
+    return lambda fn: _rate_limited(fn, delay, throttle=True)
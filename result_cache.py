@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+import numpy as np
+import pandas as pd
+
+from shared import shopping_trends
+from transport import figure_from_json, figure_json
+
+# Bounds of the process-wide cache: entry count and approximate size
+RESULT_CACHE_ENTRIES = int(os.environ.get("SHINY_RESULT_CACHE_ENTRIES", "1024"))
+RESULT_CACHE_MB = float(os.environ.get("SHINY_RESULT_CACHE_MB", "256"))
+
+
+def _canonical(value):
+    # JSON-able form of a cache key part; tuples, lists and numpy values
+    # that compare equal map to the same form
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in sorted(value.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(_canonical(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return _canonical(value.tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _sizeof(value):
+    # Approximate bytes held by a cached value
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        usage = value.memory_usage(index=True)
+        return int(usage.sum()) if isinstance(usage, pd.Series) else int(usage)
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def _freeze(value):
+    # Cached values are shared between sessions; make arrays read-only so a
+    # caller can't change another session's result in place
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _freeze(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _freeze(v)
+    return value
+
+
+def _on_event_loop():
+    # Whether this thread is running an asyncio event loop
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class ResultCache:
+    """Thread-safe LRU of computed results, shared by every session in a process.
+
+    Entries are keyed on a canonical hash of a namespace, the (normalized)
+    input values and the dataset version, so sessions with the same filters
+    share filtered row sets, aggregate tables and serialized figures. The
+    least recently used entries are evicted past `max_entries` or `max_bytes`.
+    A result being computed by one session is awaited by worker threads
+    asking for it instead of being computed twice; the event loop computes
+    its own copy instead, as waiting there would stall every session in the
+    process. Results used inside `pinned()` are kept outside the LRU and
+    never evicted.
+    """
+
+    def __init__(self, version, max_entries=RESULT_CACHE_ENTRIES, max_bytes=RESULT_CACHE_MB * 2**20):
+        self.version = version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._pinned = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.bytes = 0
+        self.pinned_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, namespace, params):
+        """Canonical hash of `namespace` and `params` for this dataset version."""
+        payload = json.dumps([self.version, _canonical(namespace), _canonical(params)], sort_keys=True)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def get_or_compute(self, namespace, params, compute):
+        """Cached result for (`namespace`, `params`), calling `compute()` on a miss."""
+        key = self.key(namespace, params)
+        pin = getattr(self._local, "pin", False)
+        with self._lock:
+            if key in self._pinned:
+                self.hits += 1
+                return self._pinned[key][0]
+            if key in self._entries:
+                self.hits += 1
+                if pin:
+                    value, size = self._entries.pop(key)
+                    self.bytes -= size
+                    self._pinned[key] = (value, size)
+                    self.pinned_bytes += size
+                    return value
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = Future()
+            # The event loop computes its own copy rather than block on
+            # another thread's; that thread stores the shared one
+            local = not owner and _on_event_loop()
+            if owner or local:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if local:
+            return _freeze(compute())
+        if not owner:
+            return pending.result()
+
+        try:
+            value = _freeze(compute())
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            pending.set_exception(e)
+            raise
+        self._store(key, value, pin)
+        pending.set_result(value)
+        return value
+
+    def _store(self, key, value, pin=False):
+        size = _sizeof(value)
+        with self._lock:
+            del self._pending[key]
+            if pin:
+                self._pinned[key] = (value, size)
+                self.pinned_bytes += size
+                return
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    @contextmanager
+    def pinned(self):
+        """Keep the results used in this block (on this thread) for good."""
+        previous = getattr(self._local, "pin", False)
+        self._local.pin = True
+        try:
+            yield self
+        finally:
+            self._local.pin = previous
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pinned.clear()
+            self.bytes = 0
+            self.pinned_bytes = 0
+
+    def stats(self):
+        """Counters and current size, e.g. for monitoring."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "pinned_entries": len(self._pinned),
+                "pinned_bytes": self.pinned_bytes,
+            }
+
+
+# The cache shared by every session of the dashboards in this process
+result_cache = ResultCache(version=shopping_trends.attrs.get("version"))
+
+
+def cached_mask(namespace, params, compute):
+    """Boolean row mask from `compute()`, shared between sessions as packed bits."""
+    def pack():
+        mask = np.asarray(compute(), dtype=bool)
+        return np.packbits(mask), len(mask)
+
+    bits, n = result_cache.get_or_compute(namespace, params, pack)
+    return np.unpackbits(bits, count=n).view(bool)
+
+
+def cached_figure(name, params, build):
+    """Plotly figure from `build()`, shared between sessions as compact JSON.
+
+    `params` must cover everything the figure depends on. A `build()` of None
+    (no figure) is cached as such.
+    """
+    def serialize():
+        fig = build()
+        return None if fig is None else figure_json(fig)
+
+    fig_json = result_cache.get_or_compute(("figure", name), params, serialize)
+    return None if fig_json is None else figure_from_json(fig_json)
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+
+# Data/shopping_trends_imputed.csv stores each categorical column as the
+# position of its label in alphabetical order. These are the label
+# dictionaries for those codes.
+PAYMENT_METHODS = ["Bank Transfer", "Cash", "Credit Card", "Debit Card", "PayPal", "Venmo"]
+
+LABELS = {
+    "Gender": ["Female", "Male"],
+    "Item_Purchased": [
+        "Backpack", "Belt", "Blouse", "Boots", "Coat", "Dress", "Gloves", "Handbag",
+        "Hat", "Hoodie", "Jacket", "Jeans", "Jewelry", "Pants", "Sandals", "Scarf",
+        "Shirt", "Shoes", "Shorts", "Skirt", "Sneakers", "Socks", "Sunglasses",
+        "Sweater", "T-shirt",
+    ],
+    "Category": ["Accessories", "Clothing", "Footwear", "Outerwear"],
+    "Location": [
+        "Alabama", "Alaska", "Arizona", "Arkansas", "California", "Colorado",
+        "Connecticut", "Delaware", "Florida", "Georgia", "Hawaii", "Idaho", "Illinois",
+        "Indiana", "Iowa", "Kansas", "Kentucky", "Louisiana", "Maine", "Maryland",
+        "Massachusetts", "Michigan", "Minnesota", "Mississippi", "Missouri", "Montana",
+        "Nebraska", "Nevada", "New Hampshire", "New Jersey", "New Mexico", "New York",
+        "North Carolina", "North Dakota", "Ohio", "Oklahoma", "Oregon", "Pennsylvania",
+        "Rhode Island", "South Carolina", "South Dakota", "Tennessee", "Texas", "Utah",
+        "Vermont", "Virginia", "Washington", "West Virginia", "Wisconsin", "Wyoming",
+    ],
+    "Size": ["L", "M", "S", "XL"],
+    "Color": [
+        "Beige", "Black", "Blue", "Brown", "Charcoal", "Cyan", "Gold", "Gray", "Green",
+        "Indigo", "Lavender", "Magenta", "Maroon", "Olive", "Orange", "Peach", "Pink",
+        "Purple", "Red", "Silver", "Teal", "Turquoise", "Violet", "White", "Yellow",
+    ],
+    "Season": ["Fall", "Spring", "Summer", "Winter"],
+    "Subscription_Status": ["No", "Yes"],
+    "Payment_Method": PAYMENT_METHODS,
+    "Shipping_Type": [
+        "2-Day Shipping", "Express", "Free Shipping", "Next Day Air", "Standard",
+        "Store Pickup",
+    ],
+    "Discount_Applied": ["No", "Yes"],
+    "Promo_Code Used": ["No", "Yes"],
+    "Preferred_Payment_Method": PAYMENT_METHODS,
+    "Frequency_of_Purchases": [
+        "Annually", "Bi-Weekly", "Every 3 Months", "Fortnightly", "Monthly",
+        "Quarterly", "Weekly",
+    ],
+}
+
+# Compact dtypes to load the CSV with: label codes fit in int8 and the
+# numeric columns are small too
+DTYPES = {
+    "Customer_ID": "int32",
+    "Age": "int8",
+    "Purchase_Amount_USD": "int16",
+    "Review_Rating": "float32",
+    "Previous_Purchases": "int16",
+    **{col: "int8" for col in LABELS},
+}
+
+_CODES = {col: {label: code for code, label in enumerate(labels)} for col, labels in LABELS.items()}
+
+
+def encode(column, labels):
+    """Codes for the `labels` of `column`, e.g. a checkbox group selection.
+
+    Labels the column doesn't know are dropped, so they match no rows.
+    """
+    codes = _CODES[column]
+    return [codes[label] for label in labels if label in codes]
+
+
+def decode(column, codes):
+    """Categorical of the labels for `codes` of `column`."""
+    return pd.Categorical.from_codes(np.asarray(codes), categories=LABELS[column])
+
+
+def decode_frame(df):
+    """Copy of `df` with its label-encoded columns and axes shown as labels.
+
+    Meant for the small frames that actually get plotted or shown, right
+    before they're rendered; filtering and grouping stay on the codes.
+    """
+    df = df.copy()
+    for col in df.columns.intersection(list(LABELS)):
+        if pd.api.types.is_integer_dtype(df[col]):
+            df[col] = decode(col, df[col])
+    if df.index.name in LABELS:
+        df.index = pd.CategoricalIndex(decode(df.index.name, df.index), name=df.index.name)
+    if df.columns.name in LABELS:
+        df.columns = pd.Index(
+            np.asarray(LABELS[df.columns.name], dtype=object)[df.columns.to_numpy()],
+            name=df.columns.name,
+        )
+    return df
+
+
+def encode_frame(df):
+    """Copy of `df` with label columns given as labels turned into their codes.
+
+    The inverse of `decode_frame` for incoming rows; columns already holding
+    codes are kept. Rows with a label the column doesn't know are dropped.
+    """
+    df = df.copy()
+    known = np.ones(len(df), dtype=bool)
+    for col in df.columns.intersection(list(LABELS)):
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            codes = df[col].map(_CODES[col])
+            known &= codes.notna().to_numpy()
+            df[col] = codes
+    df = df[known]
+    return df.astype({col: DTYPES[col] for col in df.columns if col in DTYPES})
@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import contextlib
+import importlib
+import logging
+import os
+import shutil
+import signal
+import stat
+import sys
+import tempfile
+import time
+from http.cookies import SimpleCookie
+from pathlib import Path
+
+import uvicorn
+
+# Serves a dashboard from several processes on one host, for production:
+#
+#   python serve.py --port $PORT --workers 4
+#
+# The app module is imported once here, so the dataset is loaded (and the
+# default state warmed up) before the worker processes are forked; they share
+# those pages copy-on-write. Each worker runs uvicorn on a Unix socket, and
+# this process dispatches connections to them.
+#
+# A Shiny session lives in the worker that served its websocket, so a browser
+# has to keep talking to the same one: the first response it gets sets a
+# cookie naming its worker, and its later connections go there while it's up.
+# Browsers without the cookie go to the worker with the fewest connections.
+#
+# Workers are recycled after --max-age seconds or --max-sessions sessions,
+# or all of them on SIGHUP: a replacement is started first, new sessions go
+# to it, and the old worker is stopped once its sessions have closed (or
+# after --graceful-timeout). A worker that dies is replaced.
+
+COOKIE = "shiny_worker"
+# Longest request head passed on
+MAX_HEAD_BYTES = 64 * 1024
+
+log = logging.getLogger("serve")
+
+
+class Worker:
+    """A forked uvicorn process serving the app on a Unix socket."""
+
+    def __init__(self, number, socket_dir):
+        self.number = number
+        self.path = str(Path(socket_dir) / f"worker-{number}.sock")
+        self.pid = None
+        self.started = time.monotonic()
+        self.ready = False
+        self.draining = None  # when recycling began
+        self.stopping = False
+        self.connections = 0
+        self.sessions = 0
+
+    def start(self, app, args):
+        pid = os.fork()
+        if pid:
+            self.pid = pid
+            return
+        # In the child: leave the dispatcher's sockets, event loop and signal
+        # handlers behind and serve the already imported app
+        status = 1
+        try:
+            _release_sockets()
+            asyncio.events._set_running_loop(None)
+            asyncio.set_event_loop(None)
+            signal.set_wakeup_fd(-1)
+            for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(sig, signal.SIG_DFL)
+            config = uvicorn.Config(
+                app,
+                uds=self.path,
+                log_level=args.log_level,
+                timeout_graceful_shutdown=args.graceful_timeout,
+            )
+            uvicorn.Server(config).run()
+            status = 0
+        except BaseException:
+            log.exception("Worker %d failed", self.number)
+        finally:
+            os._exit(status)
+
+    @property
+    def available(self):
+        return self.ready and self.draining is None
+
+
+class Dispatcher:
+    """Forwards connections to the workers, keeping each browser with its worker."""
+
+    def __init__(self, app, args):
+        self.app = app
+        self.args = args
+        self.socket_dir = tempfile.mkdtemp(prefix="shiny-serve-")
+        self.workers = {}
+        self._numbers = iter(range(1, sys.maxsize))
+
+    def spawn(self):
+        worker = Worker(next(self._numbers), self.socket_dir)
+        worker.start(self.app, self.args)
+        self.workers[worker.number] = worker
+        log.info("Started worker %d (pid %d)", worker.number, worker.pid)
+        return worker
+
+    def recycle(self, worker):
+        if worker.draining is None:
+            log.info("Recycling worker %d", worker.number)
+            worker.draining = time.monotonic()
+            self.spawn()
+
+    def choose(self, path, cookie):
+        """The worker for a request to `path` with the worker `cookie`, and whether to set the cookie."""
+        pinned = self.workers.get(cookie)
+        # Requests to an existing session stay with it, even on a worker being recycled
+        if pinned is not None and pinned.ready and (pinned.available or path.startswith(b"/session/")):
+            return pinned, False
+        available = [w for w in self.workers.values() if w.available]
+        if not available:
+            # Replacements still starting: the workers they replace serve meanwhile
+            available = [w for w in self.workers.values() if w.ready and not w.stopping]
+        if not available:
+            return None, False
+        return min(available, key=lambda w: w.connections), True
+
+    async def handle(self, client_reader, client_writer):
+        try:
+            head = await client_reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            client_writer.close()
+            return
+        request_line, _, headers = head.partition(b"\r\n")
+        parts = request_line.split(b" ")
+        path = parts[1] if len(parts) > 1 else b"/"
+        worker, set_cookie = self.choose(path, _worker_cookie(headers))
+        if worker is None:
+            client_writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            client_writer.close()
+            return
+        try:
+            worker_reader, worker_writer = await asyncio.open_unix_connection(worker.path)
+        except OSError:
+            client_writer.close()
+            return
+        worker.connections += 1
+        if path.startswith(b"/websocket"):
+            worker.sessions += 1
+            if self.args.max_sessions and worker.sessions >= self.args.max_sessions:
+                self.recycle(worker)
+        try:
+            worker_writer.write(head)
+            cookie = f"Set-Cookie: {COOKIE}={worker.number}; Path=/; HttpOnly; SameSite=Lax\r\n".encode() if set_cookie else None
+            await asyncio.gather(
+                _pipe(client_reader, worker_writer),
+                _pipe(worker_reader, client_writer, cookie),
+            )
+        finally:
+            worker.connections -= 1
+
+    async def supervise(self):
+        """Reap, replace and recycle workers, once a second."""
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for worker in list(self.workers.values()):
+                pid, _ = os.waitpid(worker.pid, os.WNOHANG)
+                if pid:
+                    del self.workers[worker.number]
+                    if worker.draining is None:
+                        log.warning("Worker %d (pid %d) exited; replacing it", worker.number, worker.pid)
+                        self.spawn()
+                    continue
+                if not worker.ready:
+                    # Up once its socket accepts connections
+                    try:
+                        _, writer = await asyncio.open_unix_connection(worker.path)
+                        writer.close()
+                        worker.ready = True
+                        log.info("Worker %d is ready", worker.number)
+                    except OSError:
+                        pass
+                elif worker.draining is not None and not worker.stopping:
+                    if worker.connections == 0 or now - worker.draining > self.args.graceful_timeout:
+                        # Once: a second SIGTERM makes uvicorn exit at once
+                        worker.stopping = True
+                        os.kill(worker.pid, signal.SIGTERM)
+                elif self.args.max_age and now - worker.started > self.args.max_age:
+                    self.recycle(worker)
+
+    async def serve(self):
+        for _ in range(self.args.workers):
+            self.spawn()
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        loop.add_signal_handler(signal.SIGHUP, lambda: [self.recycle(w) for w in list(self.workers.values())])
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+        server = await asyncio.start_server(self.handle, self.args.host, self.args.port, limit=MAX_HEAD_BYTES)
+        supervisor = asyncio.ensure_future(self.supervise())
+        log.info("Dispatching http://%s:%d to %d workers", self.args.host, self.args.port, self.args.workers)
+        try:
+            await stop
+        finally:
+            server.close()
+            supervisor.cancel()
+            # Workers that have exited (or been reaped) already are skipped
+            for worker in self.workers.values():
+                with contextlib.suppress(ProcessLookupError, ChildProcessError):
+                    os.kill(worker.pid, signal.SIGTERM)
+            for worker in self.workers.values():
+                with contextlib.suppress(ProcessLookupError, ChildProcessError):
+                    os.waitpid(worker.pid, 0)
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+
+def _release_sockets():
+    # Lets go of every socket inherited from the dispatcher: its listening
+    # socket, its client and worker connections and its event loop's wakeup
+    # pair. A worker holding one would keep that connection from closing
+    # until the worker exits. Each fd is pointed at /dev/null rather than
+    # closed, so the fd number stays taken: the dispatcher's objects that
+    # came along with the fork can't close a number uvicorn has reused.
+    try:
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except OSError:
+        fds = range(3, min(os.sysconf("SC_OPEN_MAX"), 65536))
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        for fd in fds:
+            if fd > 2 and fd != devnull:
+                try:
+                    if stat.S_ISSOCK(os.fstat(fd).st_mode):
+                        os.dup2(devnull, fd)
+                except OSError:
+                    pass
+    finally:
+        os.close(devnull)
+
+
+def _worker_cookie(headers):
+    # The worker number in the request's cookie, if any
+    for line in headers.split(b"\r\n"):
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"cookie":
+            morsel = SimpleCookie(value.decode("latin-1")).get(COOKIE)
+            if morsel is not None and morsel.value.isdigit():
+                return int(morsel.value)
+    return None
+
+
+async def _pipe(reader, writer, cookie=None):
+    # Copies `reader` to `writer`, adding the `cookie` header to the first response
+    try:
+        if cookie is not None:
+            head = await reader.readuntil(b"\r\n\r\n")
+            status, _, rest = head.partition(b"\r\n")
+            writer.write(status + b"\r\n" + cookie + rest)
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a dashboard from several worker processes.")
+    parser.add_argument("app", nargs="?", default="app_Jorge_Merged_version:app", help="module:attribute of the ASGI app")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8000")))
+    parser.add_argument(
+        "--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)), help="worker processes (WEB_CONCURRENCY)"
+    )
+    parser.add_argument("--max-age", type=float, default=0, help="seconds after which a worker is recycled (0 for never)")
+    parser.add_argument("--max-sessions", type=int, default=0, help="sessions after which a worker is recycled (0 for never)")
+    parser.add_argument("--graceful-timeout", type=int, default=600, help="seconds a recycled worker's sessions may stay open")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    # Loads the dataset and warms the result cache up, once for every worker
+    module, _, attr = args.app.partition(":")
+    sys.path.insert(0, str(Path(__file__).parent))
+    app = getattr(importlib.import_module(module), attr or "app")
+    asyncio.run(Dispatcher(app, args).serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,538 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+import schema
+from query import query_backend
+
 app_dir = Path(__file__).parent
-shopping_trends = pd.read_csv(app_dir / "shopping_trends.csv")
+
+log = logging.getLogger(__name__)
+
+# Typed columnar snapshots of the CSVs we load live here, one immutable
+# directory per CSV content hash plus a small JSON pointer per CSV path
+snapshot_dir = Path(os.environ.get("SHINY_SNAPSHOT_DIR", app_dir / ".snapshots"))
+
+# Set SHINY_DATASET_MODE=mmap to map the snapshot columns read-only instead of
+# loading them into each process, e.g. under several gunicorn workers
+use_mmap = os.environ.get("SHINY_DATASET_MODE", "memory") == "mmap"
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_arrays(arrays, target):
+    # Write into a temp dir and rename it into place, so concurrently booting
+    # workers either see a complete set of arrays or none at all
+    tmp = Path(tempfile.mkdtemp(dir=target.parent, prefix=f".{target.name}-"))
+    try:
+        os.chmod(tmp, 0o755)
+        for name, values in arrays.items():
+            np.save(tmp / f"{name}.npy", values, allow_pickle=False)
+        os.rename(tmp, target)
+    except OSError:
+        # Another worker won the race; its arrays are identical
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not target.exists():
+            raise
+
+
+def _write_snapshot(df, target):
+    arrays = {}
+    for i, col in enumerate(df.columns):
+        values = df[col].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str)
+        arrays[str(i)] = values
+    _write_arrays(arrays, target)
+
+
+def _write_pointer(pointer, meta):
+    tmp = pointer.with_name(f".{pointer.name}.{os.getpid()}")
+    tmp.write_text(json.dumps(meta))
+    os.replace(tmp, pointer)
+
+
+def _pointer_path(csv_path):
+    # Named after the CSV's resolved path, so CSVs with the same name in
+    # different directories each keep their own snapshot
+    key = hashlib.sha256(str(csv_path.resolve()).encode()).hexdigest()[:16]
+    return snapshot_dir / f"{csv_path.stem}-{key}.json"
+
+
+def _remove_snapshot(name):
+    # Delete a superseded snapshot unless another CSV's pointer still uses it.
+    # Processes that have it mapped keep their pages until they unmap them.
+    for pointer in snapshot_dir.glob("*.json"):
+        try:
+            if json.loads(pointer.read_text()).get("snapshot") == name:
+                return
+        except (OSError, ValueError):
+            continue
+    shutil.rmtree(snapshot_dir / name, ignore_errors=True)
+
+
+def _read_snapshot(meta, mmap):
+    target = snapshot_dir / meta["snapshot"]
+    columns = {}
+    for i, col in enumerate(meta["columns"]):
+        values = np.load(target / f"{i}.npy", mmap_mode="r" if mmap else None, allow_pickle=False)
+        # Text columns are stored as fixed-width unicode
+        columns[col] = values.astype(object) if values.dtype.kind == "U" else values
+    # copy=False keeps mapped columns backed by the snapshot files
+    return pd.DataFrame(columns, copy=False)
+
+
+def load_dataset(csv_path, dtype=None, mmap=None):
+    """Load `csv_path`, reusing a typed columnar snapshot of it when possible.
+
+    The first read parses the CSV and writes each column as a .npy file. Later
+    loads skip the CSV parser while the file's mtime and size are unchanged;
+    if only the mtime moved (say after a fresh checkout) the content hash
+    decides whether the snapshot is still valid. The content hash is kept in
+    `df.attrs["version"]`. Once a changed CSV has a new snapshot, the old one
+    is deleted.
+
+    `dtype` is passed on to `pd.read_csv`, so the snapshot stores the columns
+    in those (compact) dtypes.
+
+    With `mmap` (default: `use_mmap`) the columns are read-only memory maps of
+    the snapshot files, so every process on the host shares the same pages.
+    """
+    if mmap is None:
+        mmap = use_mmap
+    csv_path = Path(csv_path)
+    dtype = dict(dtype or {})
+    stat = csv_path.stat()
+    pointer = _pointer_path(csv_path)
+
+    meta = previous = None
+    if pointer.exists():
+        meta = json.loads(pointer.read_text())
+        previous = meta["snapshot"]
+        if meta.get("dtype") != dtype:
+            meta = None
+        elif (meta["mtime_ns"], meta["size"]) != (stat.st_mtime_ns, stat.st_size):
+            if meta["size"] != stat.st_size or meta["sha256"] != _file_sha256(csv_path):
+                meta = None
+            else:
+                meta.update(mtime_ns=stat.st_mtime_ns)
+                _write_pointer(pointer, meta)
+        if meta is not None and not (snapshot_dir / meta["snapshot"]).exists():
+            meta = None
+
+    df = None
+    if meta is not None:
+        try:
+            df = _read_snapshot(meta, mmap)
+        except OSError:
+            # Removed by another process that saw the CSV change first
+            meta = None
+    if df is None:
+        df = pd.read_csv(csv_path, dtype=dtype or None)
+        sha256 = _file_sha256(csv_path)
+        layout = hashlib.sha256(json.dumps(dtype, sort_keys=True).encode()).hexdigest()
+        meta = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": sha256,
+            "dtype": dtype,
+            "snapshot": f"{csv_path.stem}-{sha256[:16]}-{layout[:8]}",
+            "columns": list(df.columns),
+            "dtypes": [str(t) for t in df.dtypes],
+        }
+        snapshot_dir.mkdir(parents=True, exist_ok=True)
+        target = snapshot_dir / meta["snapshot"]
+        if not target.exists():
+            _write_snapshot(df, target)
+        _write_pointer(pointer, meta)
+        if previous is not None and previous != meta["snapshot"]:
+            _remove_snapshot(previous)
+        if mmap:
+            df = _read_snapshot(meta, mmap)
+
+    df.attrs["version"] = meta["sha256"]
+    df.attrs["snapshot"] = meta["snapshot"]
+    df.attrs["mmap"] = mmap
+    return df
+
+
+def derived_arrays(df, name, build):
+    """Arrays derived from a loaded dataset, stored next to its snapshot.
+
+    `build()` returns a dict of NumPy arrays keyed by file-safe names. For a
+    memory-mapped dataset the arrays are written once into its snapshot and
+    mapped read-only by every process, like the columns themselves; otherwise
+    `build()` is simply called.
+    """
+    if not df.attrs.get("mmap"):
+        return build()
+    target = snapshot_dir / df.attrs["snapshot"] / name
+    if not target.exists():
+        _write_arrays(build(), target)
+    return {path.stem: np.load(path, mmap_mode="r") for path in target.glob("*.npy")}
+
+
+# Set SHINY_DATASET to load another CSV with the same columns, e.g. a
+# synthetic one from benchmark.py
+dataset_path = Path(os.environ.get("SHINY_DATASET", app_dir / "Data" / "shopping_trends_imputed.csv"))
+
+# Categorical columns stay as their int8 codes; see schema.py for the labels.
+# With a query backend (see query.py) the rows stay in its database, and this
+# is an empty frame with the columns; the index and cube below aren't built.
+if query_backend is None:
+    shopping_trends = load_dataset(dataset_path, dtype=schema.DTYPES)
+else:
+    shopping_trends = query_backend.empty_frame()
+
+# Columns the sidebars filter on by value and by range
+INDEX_VALUE_COLUMNS = ["Gender", "Category", "Season", "Payment_Method"]
+INDEX_RANGE_COLUMNS = ["Age", "Purchase_Amount_USD"]
+
+# Set SHINY_FILTER_INDEX=0 to filter with plain pandas masks instead of the
+# precomputed index (handy for comparing the two paths)
+use_filter_index = os.environ.get("SHINY_FILTER_INDEX", "1") != "0"
+
+# Dimensions of the pre-aggregated spending cube; Age is bucketed by CUBE_AGE_BUCKET
+CUBE_DIMENSIONS = [
+    "Age", "Gender", "Category", "Season", "Payment_Method", "Discount_Applied",
+    "Subscription_Status",
+]
+CUBE_AGE_BUCKET = int(os.environ.get("SHINY_CUBE_AGE_BUCKET", "1"))
+
+# Set SHINY_CUBE=0 to aggregate the filtered rows instead of the cube
+use_cube = os.environ.get("SHINY_CUBE", "1") != "0"
+
+
+class FilterIndex:
+    """Precomputed lookups for the sidebar filters.
+
+    Every value of the value columns gets a packed bitset of the rows that hold
+    it, and every range column keeps its row positions sorted by value. Any
+    filter combination is then a few bitwise ANDs and a binary search per range.
+    """
+
+    def __init__(self, df, value_columns=INDEX_VALUE_COLUMNS, range_columns=INDEX_RANGE_COLUMNS):
+        self.n_rows = len(df)
+        self._all = np.packbits(np.ones(self.n_rows, dtype=bool))
+
+        def build():
+            arrays = {}
+            for col in value_columns:
+                uniques, codes = np.unique(df[col].to_numpy(), return_inverse=True)
+                arrays[f"{col}.values"] = uniques
+                arrays[f"{col}.bits"] = np.stack(
+                    [np.packbits(codes == i) for i in range(len(uniques))]
+                )
+            for col in range_columns:
+                values = df[col].to_numpy()
+                order = np.argsort(values, kind="stable")
+                arrays[f"{col}.sorted"] = values[order]
+                arrays[f"{col}.order"] = order
+            return arrays
+
+        # Shared between workers when the dataset is memory-mapped
+        layout = json.dumps([value_columns, range_columns]).encode()
+        arrays = derived_arrays(df, f"filter_index-{hashlib.sha1(layout).hexdigest()[:8]}", build)
+
+        # column -> ({value: row of the bit matrix}, one packed bitset per value)
+        self.bitsets = {
+            col: (
+                {value: i for i, value in enumerate(arrays[f"{col}.values"].tolist())},
+                arrays[f"{col}.bits"],
+            )
+            for col in value_columns
+        }
+        # column -> (sorted values, row positions in that order)
+        self.sorted = {
+            col: (arrays[f"{col}.sorted"], arrays[f"{col}.order"]) for col in range_columns
+        }
+
+    def extended(self, rows):
+        """Index over this index's rows followed by `rows`.
+
+        Built from this index's arrays: each bitset gets the new rows' bits
+        and each sorted range column has the new values merged in, so nothing
+        is re-grouped or re-sorted.
+        """
+        n_old, n_new = self.n_rows, len(rows)
+        index = object.__new__(FilterIndex)
+        index.n_rows = n_old + n_new
+        index._all = np.packbits(np.ones(index.n_rows, dtype=bool))
+
+        # Bits of the last, partly used byte are repacked with the new ones
+        full_bytes = n_old // 8
+        index.bitsets = {}
+        for col, (lookup, bit_matrix) in self.bitsets.items():
+            lookup = dict(lookup)
+            values = rows[col].to_numpy()
+            for value in np.unique(values).tolist():
+                if value not in lookup:
+                    lookup[value] = len(lookup)
+            tail = np.unpackbits(bit_matrix[:, full_bytes:], axis=1, count=n_old - full_bytes * 8)
+            tail = np.pad(tail, ((0, len(lookup) - len(tail)), (0, 0)))
+            new_bits = np.stack([values == value for value in lookup])
+            bit_matrix = np.pad(bit_matrix[:, :full_bytes], ((0, len(lookup) - len(bit_matrix)), (0, 0)))
+            index.bitsets[col] = (lookup, np.hstack([bit_matrix, np.packbits(np.hstack([tail, new_bits]), axis=1)]))
+
+        # New rows go after existing rows with equal values, as a stable sort would put them
+        index.sorted = {}
+        for col, (sorted_values, order) in self.sorted.items():
+            values = rows[col].to_numpy()
+            new_order = np.argsort(values, kind="stable")
+            at = np.searchsorted(sorted_values, values[new_order], side="right")
+            index.sorted[col] = (
+                np.insert(sorted_values, at, values[new_order]),
+                np.insert(order, at, n_old + new_order),
+            )
+        return index
+
+    def value_bits(self, column, values):
+        # Rows whose `column` is any of `values`; unknown values match nothing
+        lookup, bit_matrix = self.bitsets[column]
+        bits = np.zeros_like(self._all)
+        for value in values:
+            if value in lookup:
+                bits |= bit_matrix[lookup[value]]
+        return bits
+
+    def range_bits(self, column, lo, hi):
+        # Rows with lo <= `column` <= hi, found by binary search
+        sorted_values, order = self.sorted[column]
+        start = np.searchsorted(sorted_values, lo, side="left")
+        stop = np.searchsorted(sorted_values, hi, side="right")
+        if start == 0 and stop == self.n_rows:
+            return self._all
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[order[start:stop]] = True
+        return np.packbits(mask)
+
+    def mask(self, ranges=None, values=None):
+        """Boolean row mask for inclusive `ranges` and allowed `values` per column."""
+        bits = self._all.copy()
+        for col, (lo, hi) in (ranges or {}).items():
+            bits &= self.range_bits(col, lo, hi)
+        for col, allowed in (values or {}).items():
+            bits &= self.value_bits(col, allowed)
+        return np.unpackbits(bits, count=self.n_rows).astype(bool)
+
+
+filter_index = FilterIndex(shopping_trends) if query_backend is None else None
+
+
+class SpendingCube:
+    """Sum and count of a measure for every combination of the cube dimensions.
+
+    Charts roll up the cells matching the filters instead of grouping the
+    filtered rows, so their cost depends on the number of cells rather than
+    the number of rows. Age is stored as the lower bound of its bucket.
+    """
+
+    def __init__(self, df, measure="Purchase_Amount_USD", dimensions=CUBE_DIMENSIONS, age_bucket=CUBE_AGE_BUCKET):
+        self.measure = measure
+        self.dimensions = list(dimensions)
+        self.age_bucket = age_bucket
+
+        def build():
+            keys = self._cell_keys(df)
+            cells = (
+                pd.DataFrame({**keys, "sum": df[measure].to_numpy(np.float64)})
+                .groupby(self.dimensions, sort=True)["sum"]
+                .agg(["sum", "count"])
+                .reset_index()
+            )
+            return {col: cells[col].to_numpy() for col in cells.columns}
+
+        layout = json.dumps([measure, self.dimensions, age_bucket]).encode()
+        arrays = derived_arrays(df, f"cube-{hashlib.sha1(layout).hexdigest()[:8]}", build)
+        self.cells = {dim: arrays[dim] for dim in self.dimensions}
+        self.sums = arrays["sum"]
+        self.counts = arrays["count"]
+        self.n_cells = len(self.sums)
+
+    def _cell_keys(self, df):
+        keys = {dim: df[dim].to_numpy() for dim in self.dimensions}
+        if "Age" in keys:
+            keys["Age"] = keys["Age"] // self.age_bucket * self.age_bucket
+        return keys
+
+    def extended(self, rows):
+        """Cube over this cube's rows followed by `rows`.
+
+        The new rows are grouped on their own and added to the cells they fall
+        in; combinations the cube hasn't seen become new cells at the end.
+        """
+        cube = object.__new__(SpendingCube)
+        cube.measure, cube.dimensions, cube.age_bucket = self.measure, self.dimensions, self.age_bucket
+        added = (
+            pd.DataFrame({**self._cell_keys(rows), "sum": rows[self.measure].to_numpy(np.float64)})
+            .groupby(self.dimensions, sort=True)["sum"]
+            .agg(["sum", "count"])
+            .reset_index()
+        )
+        existing = pd.MultiIndex.from_arrays([self.cells[dim] for dim in self.dimensions])
+        at = existing.get_indexer(pd.MultiIndex.from_frame(added[self.dimensions]))
+        found, unseen = at >= 0, at < 0
+        cube.sums = self.sums.astype(np.float64)
+        cube.counts = self.counts.copy()
+        np.add.at(cube.sums, at[found], added["sum"].to_numpy()[found])
+        np.add.at(cube.counts, at[found], added["count"].to_numpy()[found])
+        cube.sums = np.concatenate([cube.sums, added["sum"].to_numpy()[unseen]])
+        cube.counts = np.concatenate([cube.counts, added["count"].to_numpy()[unseen]])
+        cube.cells = {
+            dim: np.concatenate([self.cells[dim], added[dim].to_numpy()[unseen].astype(self.cells[dim].dtype)])
+            for dim in self.dimensions
+        }
+        cube.n_cells = len(cube.sums)
+        return cube
+
+    def cell_mask(self, ranges=None, values=None):
+        """Mask over the cells for the same filters as `FilterIndex.mask`.
+
+        Returns None when the cube can't answer the filters exactly: a range on
+        a column that isn't a dimension, an Age range that splits a bucket, or
+        a value filter on a column that isn't a dimension.
+        """
+        mask = np.ones(self.n_cells, dtype=bool)
+        for col, (lo, hi) in (ranges or {}).items():
+            if col != "Age" or col not in self.cells:
+                return None
+            if lo % self.age_bucket or (hi + 1) % self.age_bucket:
+                return None
+            mask &= (self.cells[col] >= lo) & (self.cells[col] <= hi)
+        for col, allowed in (values or {}).items():
+            if col not in self.cells:
+                return None
+            mask &= np.isin(self.cells[col], allowed)
+        return mask
+
+    def rollup(self, by, mask):
+        """Mean of the measure per `by` group over the masked cells."""
+        groups = (
+            pd.DataFrame({**{dim: self.cells[dim][mask] for dim in by}, "sum": self.sums[mask], "count": self.counts[mask]})
+            .groupby(by, sort=True)[["sum", "count"]]
+            .sum()
+        )
+        return (groups["sum"] / groups["count"]).rename(self.measure)
+
+    def mean(self, mask):
+        """Mean of the measure over the masked cells (NaN if there are none)."""
+        count = self.counts[mask].sum()
+        return self.sums[mask].sum() / count if count else np.nan
+
+
+spending_cube = SpendingCube(shopping_trends) if query_backend is None else None
+
+
+# Rows appended while the app runs (see stream.py). Each append makes a new
+# revision: the frame, index and cube above are replaced by ones that include
+# the new rows, built from the old ones, and `data_revision` goes up last.
+# Rows are only ever appended, so the dataset as of an earlier revision is a
+# prefix of the current frame; derived results are keyed on the revision
+# they were computed for.
+data_revision = 0
+_row_counts = [len(shopping_trends)]
+# Column buffers with room to grow; frames are views of their first rows
+_buffers = None
+_append_lock = threading.Lock()
+# Recent frames of earlier revisions, so they keep their identity (and the
+# sort orders paging.py keeps per frame)
+PREFIXES_KEPT = 8
+_prefixes = OrderedDict()
+_prefixes_lock = threading.Lock()
+# The spending cube of each recent revision; it can't be cut back to an
+# earlier one like the frame can
+_cubes = OrderedDict([(0, spending_cube)])
+
+
+def rows_at(revision):
+    """Number of rows the dataset had at `revision`."""
+    return _row_counts[revision]
+
+
+def frame_at(revision):
+    """The dataset as of `revision`: the first `rows_at(revision)` rows."""
+    frame = shopping_trends
+    n_rows = _row_counts[revision]
+    if n_rows == len(frame):
+        return frame
+    with _prefixes_lock:
+        if revision not in _prefixes:
+            _prefixes[revision] = frame.iloc[:n_rows]
+            while len(_prefixes) > PREFIXES_KEPT:
+                _prefixes.popitem(last=False)
+        _prefixes.move_to_end(revision)
+        return _prefixes[revision]
+
+
+def cube_at(revision):
+    """The spending cube as of `revision`, or None if it's no longer kept."""
+    with _prefixes_lock:
+        return _cubes.get(revision)
+
+
+def rows_since(revision):
+    """The rows appended after `revision`."""
+    return shopping_trends.iloc[_row_counts[revision]:]
+
+
+def append_rows(rows):
+    """Append `rows` to the dataset and return the new revision.
+
+    `rows` has the dataset's columns, categorical ones as label codes (see
+    `schema.encode_frame`). The columns are copied into buffers that double
+    when full, and the filter index and spending cube are extended with just
+    the new rows; nothing already loaded is parsed or aggregated again.
+
+    A frame's columns have to be single arrays, so the first append copies
+    the whole dataset into this process's buffers. For a memory-mapped
+    dataset (SHINY_DATASET_MODE=mmap) that ends the sharing of its pages
+    between workers: each streaming worker then holds its own copy.
+    """
+    global shopping_trends, filter_index, spending_cube, data_revision, _buffers
+    if len(rows) == 0:
+        return data_revision
+    with _append_lock:
+        rows = rows[list(shopping_trends.columns)].astype(shopping_trends.dtypes.to_dict())
+        n_old = len(shopping_trends)
+        n_rows = n_old + len(rows)
+        if _buffers is None and shopping_trends.attrs.get("mmap"):
+            log.warning(
+                "Streaming rows into the memory-mapped dataset: its %d rows are copied into this process", n_old
+            )
+        if _buffers is None or len(next(iter(_buffers.values()))) < n_rows:
+            capacity = max(n_rows, 2 * n_old)
+            grown = {}
+            for col in shopping_trends.columns:
+                grown[col] = np.empty(capacity, dtype=shopping_trends[col].dtype)
+                grown[col][:n_old] = shopping_trends[col].to_numpy()
+            _buffers = grown
+        for col, buffer in _buffers.items():
+            buffer[n_old:n_rows] = rows[col].to_numpy()
+
+        frame = pd.DataFrame({col: buffer[:n_rows] for col, buffer in _buffers.items()}, copy=False)
+        frame.attrs.update(shopping_trends.attrs, mmap=False)
+        index = filter_index.extended(rows)
+        cube = spending_cube.extended(rows)
+        shopping_trends, filter_index, spending_cube = frame, index, cube
+        _row_counts.append(n_rows)
+        with _prefixes_lock:
+            _cubes[len(_row_counts) - 1] = cube
+            while len(_cubes) > PREFIXES_KEPT:
+                _cubes.popitem(last=False)
+        data_revision += 1
+        return data_revision
@@ -0,0 +1,199 @@
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from shiny import reactive
+
+import schema
+import shared
+
+# Set SHINY_STREAM_SOURCE to an append-only .csv or .jsonl file, or to an
+# SQLite database (rows of SHINY_STREAM_TABLE), to add its rows to the
+# dashboards' data as they arrive, checking for new ones every
+# SHINY_STREAM_INTERVAL seconds. Rows already there when the app starts are
+# added too. Columns are the dataset's; categorical ones may hold labels or codes.
+# Appending copies a memory-mapped dataset into each worker; see
+# shared.append_rows.
+STREAM_SOURCE = os.environ.get("SHINY_STREAM_SOURCE")
+STREAM_TABLE = os.environ.get("SHINY_STREAM_TABLE", "purchases")
+STREAM_INTERVAL = float(os.environ.get("SHINY_STREAM_INTERVAL", "2"))
+# Most data read (and appended as one revision) at a time
+STREAM_CHUNK_MB = float(os.environ.get("SHINY_STREAM_CHUNK_MB", "8"))
+
+log = logging.getLogger(__name__)
+
+
+class FileTail:
+    """Complete lines appended to a file since the last read."""
+
+    def __init__(self, path, chunk_bytes=int(STREAM_CHUNK_MB * 2**20)):
+        self.path = Path(path)
+        self.chunk_bytes = chunk_bytes
+        self.offset = 0
+
+    def read_lines(self):
+        """Up to `chunk_bytes` of new complete lines (b"" if there are none)."""
+        if not self.path.exists():
+            return b""
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(self.chunk_bytes)
+        # A line still being written is left for the next read
+        end = data.rfind(b"\n") + 1
+        if end == 0 and len(data) == self.chunk_bytes:
+            raise ValueError(f"{self.path}: line longer than {self.chunk_bytes} bytes")
+        self.offset += end
+        return data[:end]
+
+
+class CsvSource(FileTail):
+    """New rows of a CSV file that's only ever appended to."""
+
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        self.header = None
+
+    def read(self):
+        if self.header is None:
+            lines = self.read_lines()
+            if not lines:
+                return None
+            # Only the header line has been consumed
+            self.header = lines[: lines.index(b"\n") + 1]
+            self.offset = len(self.header)
+        data = self.read_lines()
+        return pd.read_csv(io.BytesIO(self.header + data)) if data else None
+
+
+class JsonlSource(FileTail):
+    """New rows of a JSON Lines file that's only ever appended to."""
+
+    def read(self):
+        data = self.read_lines()
+        return pd.read_json(io.BytesIO(data), lines=True) if data.strip() else None
+
+
+class SqliteSource:
+    """Rows of an SQLite table with a rowid above the last one read."""
+
+    def __init__(self, path, table=STREAM_TABLE, chunk_rows=500_000):
+        self.path = Path(path)
+        self.table = table
+        self.chunk_rows = chunk_rows
+        self.last_rowid = 0
+
+    def read(self):
+        if not self.path.exists():
+            return None
+        query = f'SELECT rowid AS "__rowid__", * FROM "{self.table}" WHERE rowid > ? ORDER BY rowid LIMIT ?'
+        with closing(sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)) as conn:
+            rows = pd.read_sql_query(query, conn, params=(self.last_rowid, self.chunk_rows))
+        if rows.empty:
+            return None
+        self.last_rowid = int(rows.pop("__rowid__").iloc[-1])
+        return rows
+
+
+def source_of(spec, table=STREAM_TABLE):
+    """Source for a SHINY_STREAM_SOURCE path, by its extension."""
+    suffix = Path(spec).suffix.lower()
+    if suffix == ".csv":
+        return CsvSource(spec)
+    if suffix in (".jsonl", ".ndjson"):
+        return JsonlSource(spec)
+    if suffix in (".db", ".sqlite", ".sqlite3"):
+        return SqliteSource(spec, table)
+    raise ValueError(f"Don't know how to stream {spec!r}; use a .csv, .jsonl or SQLite file")
+
+
+def ingest(source):
+    """Append everything new in `source` to the shared dataset, a chunk per revision.
+
+    Returns the number of rows appended.
+    """
+    appended = 0
+    while (rows := source.read()) is not None:
+        rows = schema.encode_frame(rows)
+        shared.append_rows(rows)
+        appended += len(rows)
+    return appended
+
+
+_follower = None
+_follower_lock = threading.Lock()
+
+
+def start(spec=STREAM_SOURCE, interval=STREAM_INTERVAL):
+    """Follow `spec` on a background thread, once per process.
+
+    Called by `watch()`, so the thread starts in the process serving the
+    sessions (after any fork) rather than at import.
+    """
+    global _follower
+    if shared.query_backend is not None:
+        raise RuntimeError("SHINY_STREAM_SOURCE appends to the in-memory dataset; it can't be used with SHINY_QUERY_SOURCE")
+    with _follower_lock:
+        if _follower is not None and _follower[0] == os.getpid():
+            return
+        source = source_of(spec)
+
+        def follow():
+            while True:
+                try:
+                    ingest(source)
+                except Exception:
+                    # The chunk is skipped; later rows still come through
+                    log.exception("Appending rows from %s failed", spec)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=follow, name="shiny-stream", daemon=True)
+        thread.start()
+        _follower = (os.getpid(), thread)
+
+
+def watch(state, revision_of, matches, interval=STREAM_INTERVAL):
+    """Reactive value that changes when appended rows match a session's filters.
+
+    `state()` is the session's filter state, `revision_of(state)` the data
+    revision it was made at and `matches(state, rows)` a boolean mask of the
+    `rows` its filters select. Read the returned value in the calc making
+    the state and have it take `shared.data_revision`: rows the filters
+    don't select leave the session's outputs alone, while matching rows move
+    its state (and so the result cache keys) to the new revision. A filter
+    change picks up the latest revision anyway.
+
+    Without SHINY_STREAM_SOURCE the data never changes and this does nothing.
+    """
+    if not STREAM_SOURCE:
+        return lambda: None
+    start()
+    changes = reactive.value(0)
+
+    @reactive.poll(lambda: shared.data_revision, interval)
+    def latest():
+        return shared.data_revision
+
+    # The state last checked and the revision it was checked up to; rows up
+    # to there didn't match it, so they aren't scanned again
+    checked = [None, None]
+
+    @reactive.effect
+    def _check():
+        revision = latest()
+        with reactive.isolate():
+            current = state()
+            since = revision_of(current)
+            if checked[0] == current:
+                since = max(since, checked[1])
+            checked[:] = [current, revision]
+            if revision > since and np.any(matches(current, shared.rows_since(since))):
+                changes.set(changes() + 1)
+
+    return changes
@@ -0,0 +1,27 @@
+import pytest
+
+from paging import column_filter
+
+
+@pytest.mark.parametrize(
+    "text, bounds",
+    [
+        ("30", (30.0, 30.0)),
+        ("20-40", (20.0, 40.0)),
+        ("20..40", (20.0, 40.0)),
+        (" 2.5 .. 7.5 ", (2.5, 7.5)),
+        ("-5-5", (-5.0, 5.0)),
+    ],
+)
+def test_numeric_filters(text, bounds):
+    assert column_filter("Age", text) == ({"Age": bounds}, {})
+
+
+@pytest.mark.parametrize("text", [".", "1.2.3", "..", "20..", "abc", "20-40-60", "1e5"])
+def test_unparseable_filters_match_nothing(text):
+    assert column_filter("Age", text) == ({}, {"Age": []})
+
+
+def test_no_filter():
+    assert column_filter("Age", "  ") is None
+    assert column_filter(None, "20") is None
@@ -0,0 +1,130 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import textwrap
+import time
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("uvicorn")
+
+# serve.py with a small ASGI app: /slow answers after a second, /hold streams
+# until the client goes away
+APP = textwrap.dedent(
+    """
+    import asyncio
+
+    async def app(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain")]})
+        if scope["path"] == "/slow":
+            await asyncio.sleep(1)
+            await send({"type": "http.response.body", "body": b"done"})
+            return
+        await send({"type": "http.response.body", "body": b"holding", "more_body": True})
+        while (await receive())["type"] != "http.disconnect":
+            pass
+    """
+)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _workers(dispatcher):
+    out = subprocess.run(["pgrep", "-P", str(dispatcher.pid)], capture_output=True, text=True).stdout
+    return {int(pid) for pid in out.split()}
+
+
+def _wait_for(condition, timeout):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def _request(port, path):
+    conn = socket.create_connection(("127.0.0.1", port), timeout=10)
+    conn.sendall(f"GET {path} HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n".encode())
+    return conn
+
+
+def _read_to_eof(conn):
+    data = b""
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            return data
+        data += chunk
+
+
+@pytest.fixture(params=[1])
+def dispatcher(request, tmp_path):
+    (tmp_path / "tiny_app.py").write_text(APP)
+    port = _free_port()
+    proc = subprocess.Popen(
+        [sys.executable, str(Path(__file__).parent / "serve.py"), "tiny_app:app", "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(request.param), "--graceful-timeout", "60", "--log-level", "warning"],
+        env=dict(os.environ, PYTHONPATH=str(tmp_path)),
+    )
+
+    def up():
+        try:
+            return _read_to_eof(_request(port, "/slow")).startswith(b"HTTP/1.1 200")
+        except OSError:
+            return False
+
+    assert _wait_for(up, 30), "serve.py didn't come up"
+    proc.port = port
+    yield proc
+    workers = _workers(proc)
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        for pid in workers | {proc.pid}:
+            os.kill(pid, signal.SIGKILL)
+        proc.wait()
+
+
+def test_recycling_keeps_connections_closable(dispatcher):
+    old_workers = _workers(dispatcher)
+    held = _request(dispatcher.port, "/hold")
+    assert held.recv(65536).startswith(b"HTTP/1.1 200")
+    slow = _request(dispatcher.port, "/slow")
+    head = slow.recv(65536)
+    assert head.startswith(b"HTTP/1.1 200")
+
+    # The replacement worker is forked while both connections are open
+    dispatcher.send_signal(signal.SIGHUP)
+    assert _wait_for(lambda: _workers(dispatcher) - old_workers, 10), "no replacement worker"
+
+    # The old worker's response ends: the client sees the connection close
+    assert b"done" in head + _read_to_eof(slow)
+
+    # The client goes away: the old worker sees it, and once drained is stopped
+    held.close()
+    assert _wait_for(lambda: not _workers(dispatcher) & old_workers, 10), "old worker still holds a connection"
+
+
+@pytest.mark.parametrize("dispatcher", [2], indirect=True)
+def test_shutdown_stops_every_worker_after_one_died(dispatcher):
+    workers = _workers(dispatcher)
+    assert len(workers) == 2
+    dead = min(workers)
+    os.kill(dead, signal.SIGKILL)
+    # Shut down before the dispatcher's supervisor notices
+    dispatcher.send_signal(signal.SIGTERM)
+    assert dispatcher.wait(10) == 0
+    for pid in workers - {dead}:
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
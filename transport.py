@@ -0,0 +1,128 @@
+import base64
+import json
+
+import numpy as np
+import plotly.graph_objects as go
+
+# numpy dtypes plotly.js takes as typed arrays, by their short names
+TYPED_ARRAY_DTYPES = {
+    "int8": "i1",
+    "uint8": "u1",
+    "int16": "i2",
+    "uint16": "u2",
+    "int32": "i4",
+    "uint32": "u4",
+    "float32": "f4",
+    "float64": "f8",
+}
+_INT_DTYPES = [np.int8, np.uint8, np.int16, np.uint16, np.int32, np.uint32]
+
+
+def compact_array(values):
+    """`values` as the smallest typed array holding them, or None if not numeric.
+
+    Whole numbers become the narrowest integer type that fits, other floats
+    float32, which is beyond what a plot or its hover labels show. Arrays
+    with gaps (None or NaN) are left alone.
+    """
+    try:
+        arr = np.asarray(values)
+    except ValueError:
+        return None
+    if arr.size == 0 or arr.dtype.kind not in "iuf":
+        return None
+    if arr.dtype.kind == "f":
+        if not np.isfinite(arr).all():
+            return None
+        if not np.array_equal(arr, np.round(arr)):
+            return arr.astype(np.float32)
+    low, high = arr.min(), arr.max()
+    for dtype in _INT_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return arr.astype(dtype)
+    return arr.astype(np.float64) if arr.dtype.kind == "f" else arr
+
+
+def typed_array(arr):
+    """plotly.js typed-array spec (base64 data) of a numeric array."""
+    spec = {"dtype": TYPED_ARRAY_DTYPES[arr.dtype.name], "bdata": base64.b64encode(np.ascontiguousarray(arr)).decode("ascii")}
+    if arr.ndim > 1:
+        spec["shape"] = ", ".join(str(n) for n in arr.shape)
+    return spec
+
+
+def typed_arrays(obj):
+    """Figure JSON with its typed-array specs decoded into numpy arrays.
+
+    Widgets send numpy arrays as binary buffers, so a figure built from this
+    goes out as compactly as it was stored.
+    """
+    if isinstance(obj, dict):
+        if "bdata" in obj and "dtype" in obj:
+            values = np.frombuffer(base64.b64decode(obj["bdata"]), dtype=obj["dtype"])
+            shape = obj.get("shape")
+            if isinstance(shape, str):
+                shape = [int(n) for n in shape.split(",")]
+            return values.reshape(shape) if shape else values
+        return {k: typed_arrays(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [typed_arrays(v) for v in obj]
+    return obj
+
+
+# Per-point trace properties that may come as plain lists; others, like a
+# pie's domain.x, are fixed-length settings plotly.js wants as lists
+_DATA_ARRAYS = {"x", "y", "z", "customdata", "values", "marker.color", "marker.size"}
+
+
+def _compact(obj, path=""):
+    # Numeric data in a trace as compact typed arrays; everything else as it was
+    if isinstance(obj, dict):
+        if "bdata" in obj and "dtype" in obj:
+            arr = compact_array(typed_arrays(obj))
+            return obj if arr is None else typed_array(arr)
+        return {k: _compact(v, f"{path}.{k}" if path else k) for k, v in obj.items()}
+    if isinstance(obj, list) and path in _DATA_ARRAYS:
+        arr = compact_array(obj)
+        return obj if arr is None else typed_array(arr)
+    if isinstance(obj, list):
+        return [_compact(v, path) for v in obj]
+    return obj
+
+
+def figure_json(fig):
+    """JSON of `fig` with its trace data as compact typed arrays."""
+    fig_dict = json.loads(fig.to_json())
+    fig_dict["data"] = [_compact(trace) for trace in fig_dict.get("data", [])]
+    return json.dumps(fig_dict, separators=(",", ":"))
+
+
+def figure_from_json(fig_json):
+    """Figure from `figure_json()`, with its data arrays kept typed."""
+    return go.Figure(typed_arrays(json.loads(fig_json)))
+
+
+def figure_diff(old, new):
+    """What changed from figure dict `old` to `new` (as from `json.loads(figure_json(...))`).
+
+    Returns `{"data": {trace index: {property: value}}, "layout": {key: value}}`
+    with only the traces, properties and top-level layout keys that changed,
+    so an update where only the data changed carries no layout at all. None
+    if the traces were added, removed or changed type; the figure has to be
+    replaced then.
+    """
+    old_data, new_data = old.get("data", []), new.get("data", [])
+    if len(old_data) != len(new_data) or any(o.get("type") != n.get("type") for o, n in zip(old_data, new_data)):
+        return None
+    data = {}
+    for i, (o, n) in enumerate(zip(old_data, new_data)):
+        changed = {k: v for k, v in n.items() if o.get(k) != v}
+        # Properties the new trace no longer sets go back to their defaults
+        changed.update({k: None for k in o if k not in n})
+        if changed:
+            data[i] = changed
+    old_layout, new_layout = old.get("layout", {}), new.get("layout", {})
+    layout = {k: v for k, v in new_layout.items() if old_layout.get(k) != v}
+    layout.update({k: None for k in old_layout if k not in new_layout})
+    return {"data": data, "layout": layout}
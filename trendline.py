@@ -0,0 +1,139 @@
+import os
+
+import numpy as np
+import plotly.graph_objects as go
+
+import schema
+from query import Selection
+from result_cache import result_cache
+
+try:
+    from statsmodels.nonparametric.smoothers_lowess import lowess as exact_lowess
+except ImportError:  # statsmodels is optional; the binned fit needs only NumPy
+    exact_lowess = None
+
+# Share of the points each local fit uses, as in statsmodels' and plotly's LOWESS
+LOWESS_FRAC = 2 / 3
+# Groups with at most this many points get the exact LOWESS when it's available
+EXACT_LOWESS_MAX_POINTS = int(os.environ.get("SHINY_EXACT_LOWESS_MAX_POINTS", "1000"))
+# x bins of the approximate fit; its cost depends on these, not on the points
+TRENDLINE_BINS = int(os.environ.get("SHINY_TRENDLINE_BINS", "200"))
+
+
+def binned_lowess(x, y, frac=LOWESS_FRAC, bins=TRENDLINE_BINS):
+    """Local linear regression of `y` on `x`, evaluated at the x bin means.
+
+    Points are summarised per x bin (count and sums of x, y, x^2 and xy), and
+    one tricube-weighted linear fit is solved per bin, vectorized over all bins
+    at once. The bandwidth of each fit covers `frac` of the points, as in
+    LOWESS. Unlike statsmodels there are no robustifying iterations.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(x.min(), x.max(), bins + 1)
+    which = np.clip(np.searchsorted(edges, x, side="right") - 1, 0, bins - 1)
+
+    n = np.bincount(which, minlength=bins)
+    sums = [np.bincount(which, weights=w, minlength=bins) for w in (x, y, x * x, x * y)]
+    present = n > 0
+    return fit_bins(n[present], *(s[present] for s in sums), frac=frac)
+
+
+def fit_bins(n, sx, sy, sxx, sxy, frac=LOWESS_FRAC):
+    """The fit of `binned_lowess` from its per-bin sums, over bins that have points.
+
+    Lets the sums come from elsewhere, such as a query backend
+    (`query.Selection.bin_sums`).
+    """
+    n = np.asarray(n, dtype=np.float64)
+    centres = sx / n
+
+    # Bandwidth per fit: distance to the bin where `frac` of the points is reached
+    dist = np.abs(centres[:, None] - centres[None, :])
+    order = np.argsort(dist, axis=1)
+    reach = np.cumsum(n[order], axis=1) >= frac * n.sum()
+    nearest = np.take_along_axis(dist, order, axis=1)
+    h = nearest[np.arange(len(centres)), reach.argmax(axis=1)]
+    h = np.maximum(h * 1.0001, 1e-12)
+
+    w = np.clip(1 - (dist / h[:, None]) ** 3, 0, None) ** 3
+    s0, s1, s2, t0, t1 = (w @ s for s in (n, sx, sxx, sy, sxy))
+    det = s0 * s2 - s1 * s1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where(np.abs(det) > 1e-12, (s0 * t1 - s1 * t0) / det, 0.0)
+        fitted = (t0 - slope * s1) / s0 + slope * centres
+    return centres, fitted
+
+
+def lowess_line(x, y, frac=LOWESS_FRAC):
+    """(x, y) of a LOWESS trendline; exact for small inputs, binned otherwise."""
+    if exact_lowess is not None and len(x) <= EXACT_LOWESS_MAX_POINTS:
+        fit = exact_lowess(np.asarray(y, dtype=np.float64), np.asarray(x, dtype=np.float64), frac=frac)
+        return fit[:, 0], fit[:, 1]
+    return binned_lowess(x, y, frac=frac)
+
+
+def trendlines(df, x, y, color=None, key=None):
+    """LOWESS trendline of `y` on `x` for each `color` group of `df`.
+
+    Returns {group label: (xs, ys)}, with a single None group when there's no
+    `color`. When `key` is given (say the filter state and colour variable),
+    results are shared between sessions through the result cache.
+    """
+    if key is not None:
+        return result_cache.get_or_compute("trendlines", [key, x, y, color], lambda: trendlines(df, x, y, color))
+    if isinstance(df, Selection):
+        return _selection_trendlines(df, x, y, color)
+
+    lines = {}
+    if color is None:
+        if len(df) > 1:
+            lines[None] = lowess_line(df[x].to_numpy(), df[y].to_numpy())
+    else:
+        for value, group in df.groupby(color, sort=True):
+            if len(group) > 1:
+                label = schema.decode(color, [value])[0] if color in schema.LABELS else value
+                lines[label] = lowess_line(group[x].to_numpy(), group[y].to_numpy())
+    return lines
+
+
+def _selection_trendlines(selection, x, y, color):
+    # `trendlines()` for a query.Selection: bin sums come from the database,
+    # and only groups small enough for the exact fit fetch their points
+    lines = {}
+    for value, sums in selection.bin_sums(x, y, TRENDLINE_BINS, color).items():
+        n_points = sums[0].sum()
+        if n_points <= 1:
+            continue
+        label = value if color is None or color not in schema.LABELS else schema.decode(color, [value])[0]
+        if exact_lowess is not None and n_points <= EXACT_LOWESS_MAX_POINTS:
+            group = selection[[x, y]] if color is None else selection.narrowed(values={color: [value]})[[x, y]]
+            points = group.rows()
+            lines[label] = lowess_line(points[x].to_numpy(), points[y].to_numpy())
+        else:
+            lines[label] = fit_bins(*sums)
+    return lines
+
+
+def add_trendlines(fig, lines):
+    """Add `trendlines()` output to `fig`, coloured like the matching traces."""
+    colors = {
+        trace.name: trace.marker.color
+        for trace in fig.data
+        if trace.type in ("scatter", "scattergl") and trace.marker is not None
+    }
+    for label, (xs, ys) in lines.items():
+        name = None if label is None else str(label)
+        fig.add_trace(
+            go.Scatter(
+                x=xs,
+                y=ys,
+                mode="lines",
+                name=name,
+                legendgroup=name,
+                showlegend=False,
+                line=dict(color=colors.get(name or "")),
+                hoverinfo="skip",
+            )
+        )
+    return fig
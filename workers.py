@@ -0,0 +1,158 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from shiny import reactive, req
+from shiny.session import get_current_session
+
+# Threads computing heavy results off the event loop. NumPy and pandas release
+# the GIL in their kernels, so these overlap with each other and with the loop.
+WORKER_THREADS = int(os.environ.get("SHINY_WORKER_THREADS", str(min(4, os.cpu_count() or 1))))
+# Jobs one session may have in the pool at once; the rest of its jobs wait
+# their turn, so a session asking for a lot can't take every thread
+SESSION_JOBS = int(os.environ.get("SHINY_SESSION_JOBS", "2"))
+
+executor = ThreadPoolExecutor(WORKER_THREADS, thread_name_prefix="shiny-worker")
+
+# Per event loop; created on first use since asyncio primitives bind to a loop
+_pool_slots = None
+_session_slots = {}
+_counts = {"queued": 0, "running": 0, "done": 0, "dropped": 0}
+_counts_lock = threading.Lock()
+
+
+def _count(**changes):
+    with _counts_lock:
+        for name, change in changes.items():
+            _counts[name] += change
+
+
+def stats():
+    """Jobs waiting for a slot, running, finished and dropped as stale."""
+    with _counts_lock:
+        return dict(_counts)
+
+
+class BackgroundCalc:
+    """Reactive result of `compute(*args())`, computed on the worker pool.
+
+    Reading it from an output (or calc) reads `args()` there, on the event
+    loop, and submits `compute` with them if they changed. Until the result
+    is in, the output shows as recalculating and keeps its previous content;
+    when it arrives the output runs again and gets it. Nothing is computed
+    until something reads it, so outputs suspended on hidden tabs cost
+    nothing. A result for arguments that have since changed is dropped, and
+    jobs still waiting for a slot are skipped or, when the session ends,
+    cancelled.
+
+    `compute` runs in a worker thread and mustn't read reactive values.
+    """
+
+    def __init__(self, compute, args, session=None):
+        self._compute = compute
+        self._args = args
+        self._session = session if session is not None else get_current_session()
+        self._generation = 0
+        self._submitted = None
+        self._result = None
+        self._task = None
+        self._in_pool = False
+        self._finished = reactive.value(0)
+        if self._session is not None:
+            self._session.on_ended(self.cancel)
+
+    def __call__(self):
+        args = tuple(self._args())
+        self._finished()
+        if self._submitted is None or self._submitted[0] != args:
+            self._submit(args)
+        if self._result is None or self._result[0] != args:
+            req(False, cancel_output="progress")
+        _, error, value = self._result
+        if error is not None:
+            raise error
+        return value
+
+    def _submit(self, args):
+        self._drop_pending()
+        self._submitted = (args, self._generation)
+        self._task = asyncio.create_task(self._run(self._generation, args))
+
+    def _drop_pending(self):
+        # A job still waiting for a slot is cancelled; one already running is
+        # left to finish and its result ignored
+        self._generation += 1
+        if self._task is not None and not self._in_pool:
+            self._task.cancel()
+
+    async def _run(self, generation, args):
+        global _pool_slots
+        if _pool_slots is None:
+            _pool_slots = asyncio.Semaphore(WORKER_THREADS)
+        key = getattr(self._session, "id", None)
+        if key not in _session_slots:
+            _session_slots[key] = asyncio.Semaphore(SESSION_JOBS)
+        session_slots = _session_slots[key]
+
+        _count(queued=1)
+        waiting = True
+        try:
+            async with session_slots, _pool_slots:
+                waiting = False
+                if generation != self._generation:
+                    # Superseded while waiting; don't spend a thread on it
+                    _count(queued=-1, dropped=1)
+                    return
+                _count(queued=-1, running=1)
+                self._in_pool = True
+                loop = asyncio.get_running_loop()
+                try:
+                    value = await loop.run_in_executor(executor, self._compute, *args)
+                    error = None
+                except Exception as e:
+                    value, error = None, e
+                finally:
+                    self._in_pool = False
+                    _count(running=-1, done=1)
+        except asyncio.CancelledError:
+            if waiting:
+                _count(queued=-1, dropped=1)
+            raise
+
+        if generation != self._generation:
+            _count(dropped=1)
+            return
+        async with reactive.lock():
+            self._result = (args, error, value)
+            with reactive.isolate():
+                self._finished.set(self._finished() + 1)
+            await reactive.flush()
+
+    def skip_queued(self):
+        """Cancel a job still waiting for a slot, to be submitted again when next read.
+
+        A job already running is left to finish and its result kept.
+        """
+        if self._task is None or self._task.done() or self._in_pool:
+            return
+        self._drop_pending()
+        self._submitted = None
+        # Readers waiting for the result run again (once shown) and resubmit
+        with reactive.isolate():
+            self._finished.set(self._finished() + 1)
+
+    def cancel(self):
+        """Drop pending work: skip queued jobs and ignore running ones."""
+        self._drop_pending()
+        _session_slots.pop(getattr(self._session, "id", None), None)
+
+
+def background(args):
+    """Decorator making `BackgroundCalc(fn, args)` of a function.
+
+    `args` is a reactive function returning the arguments for `fn`; read
+    everything reactive there, and do the heavy lifting in `fn`. Create it
+    in a session (inside `server()`, or at the top level of an express app).
+    """
+    return lambda fn: BackgroundCalc(fn, args)